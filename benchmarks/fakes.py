@@ -0,0 +1,249 @@
+"""
+Local stand-ins for the QQ gateway, QQ OpenAPI and Gemini.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+import websockets
+
+Handler = Callable[[str, str, bytes], Awaitable[tuple[int, Any]]]
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Error"}
+
+
+class HTTPServer:
+    """
+    Just enough HTTP/1.1 with keep-alive for httpx to talk to
+    """
+
+    def __init__(self, handler: Handler) -> None:
+        self.handler = handler
+        self.server: asyncio.Server | None = None
+        self.port = 0
+
+    async def start(self, host: str = "127.0.0.1") -> None:
+        self.server = await asyncio.start_server(self._serve, host, 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                length = 0
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+                body = await reader.readexactly(length) if length else b""
+                status, payload = await self.handler(method, target, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode()
+                    + (data if method != "HEAD" else b"")
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeGateway:
+    """
+    Speak hello/identify/ready/resume/heartbeat and push dispatch events
+    """
+
+    def __init__(self, heartbeat_interval: int = 41250) -> None:
+        self.heartbeat_interval = heartbeat_interval
+        self.connections: set[Any] = set()
+        self.seq = itertools.count(1)
+        self.ready = asyncio.Event()
+        self.ready_at: float | None = None
+        self.server: Any = None
+        self.port = 0
+
+    async def start(self) -> None:
+        self.server = await websockets.serve(self._serve, "127.0.0.1", 0)
+        self.port = next(iter(self.server.sockets)).getsockname()[1]
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}"
+
+    async def _serve(self, websocket: Any, *_: Any) -> None:
+        await websocket.send(
+            json.dumps({"op": 10, "d": {"heartbeat_interval": self.heartbeat_interval}})
+        )
+        try:
+            async for data in websocket:
+                event = json.loads(data)
+                match event["op"]:
+                    case 1:
+                        await websocket.send(json.dumps({"op": 11}))
+                    case 2:
+                        await websocket.send(
+                            json.dumps(
+                                {
+                                    "op": 0,
+                                    "s": next(self.seq),
+                                    "t": "READY",
+                                    "d": {"session_id": "benchmark", "version": 1},
+                                }
+                            )
+                        )
+                        self._connected(websocket)
+                    case 6:
+                        await websocket.send(
+                            json.dumps({"op": 0, "s": next(self.seq), "t": "RESUMED"})
+                        )
+                        self._connected(websocket)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(websocket)
+
+    def _connected(self, websocket: Any) -> None:
+        self.connections.add(websocket)
+        if self.ready_at is None:
+            self.ready_at = time.perf_counter()
+        self.ready.set()
+
+    async def dispatch(self, t: str, d: dict[str, Any]) -> None:
+        data = json.dumps({"op": 0, "s": next(self.seq), "t": t, "d": d})
+        for websocket in tuple(self.connections):
+            await websocket.send(data)
+
+
+class FakeOpenAPI:
+    """
+    Serve `/gateway`, `/v2/groups/*/files` and `/v2/groups/*/messages`,
+    recording when each reply arrives
+    """
+
+    def __init__(self, gateway_url: str) -> None:
+        self.gateway_url = gateway_url
+        self.http = HTTPServer(self.handle)
+        self.replies: dict[str, float] = {}
+        self.on_reply: Callable[[str], None] | None = None
+
+    async def handle(self, method: str, target: str, body: bytes) -> tuple[int, Any]:
+        path = target.split("?", 1)[0]
+        if method == "GET" and path == "/gateway":
+            return 200, {"url": self.gateway_url}
+        if method == "POST" and path.startswith("/v2/groups/"):
+            if path.endswith("/files"):
+                return 200, {"file_info": "benchmark", "ttl": 0}
+            if path.endswith("/messages"):
+                msg_id = json.loads(body).get("msg_id")
+                if msg_id is not None and msg_id not in self.replies:
+                    self.replies[msg_id] = time.perf_counter()
+                    if self.on_reply is not None:
+                        self.on_reply(msg_id)
+                return 200, {"id": "benchmark", "timestamp": 0}
+        return 404, {"message": "not found"}
+
+
+class FakeGemini:
+    """
+    Answer generateContent with log-normal latency and a configurable mix of
+    server errors and safety blocks
+    """
+
+    def __init__(
+        self,
+        *,
+        latency: float = 1.0,
+        jitter: float = 0.5,
+        error_rate: float = 0.0,
+        safety_rate: float = 0.0,
+        seed: int | None = None,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.safety_rate = safety_rate
+        self.random = random.Random(seed)
+        self.http = HTTPServer(self.handle)
+        self.requests = 0
+
+    def _delay(self) -> float:
+        if self.latency <= 0:
+            return 0
+        return self.random.lognormvariate(0, self.jitter) * self.latency
+
+    async def handle(self, method: str, target: str, body: bytes) -> tuple[int, Any]:
+        if method != "POST":
+            return 404, {"error": {"message": "not found"}}
+        self.requests += 1
+        await asyncio.sleep(self._delay())
+        roll = self.random.random()
+        if roll < self.error_rate:
+            return 500, {"error": {"message": "benchmark error"}}
+        if roll < self.error_rate + self.safety_rate:
+            return 200, {"promptFeedback": {"blockReason": "SAFETY"}}
+        return 200, {
+            "candidates": [
+                {"content": {"parts": [{"text": "派蒙知道！"}], "role": "model"}}
+            ]
+        }
+
+
+def bot_environ(openapi: FakeOpenAPI, gemini: FakeGemini) -> dict[str, str]:
+    """
+    Environment that points `main` at the fakes
+    """
+    return {
+        "BOT_ID": "benchmark",
+        "BOT_TOKEN": "benchmark",
+        "BOT_URL": openapi.http.url,
+        "GEMINI_PRO_KEY": "benchmark",
+        "GEMINI_PRO_URL": gemini.http.url + "/gemini-pro:generateContent",
+        "GEMINI_PRO_VISION_URL": gemini.http.url
+        + "/gemini-pro-vision:generateContent",
+    }
+
+
+async def start_fakes(
+    gemini: FakeGemini,
+) -> tuple[FakeGateway, FakeOpenAPI, FakeGemini]:
+    gateway = FakeGateway()
+    await gateway.start()
+    openapi = FakeOpenAPI(gateway.url)
+    await openapi.http.start()
+    await gemini.http.start()
+    logger.info(
+        f"Fake gateway {gateway.url}, OpenAPI {openapi.http.url},"
+        f" Gemini {gemini.http.url}"
+    )
+    return gateway, openapi, gemini
+
+
+async def stop_fakes(
+    gateway: FakeGateway, openapi: FakeOpenAPI, gemini: FakeGemini
+) -> None:
+    await gemini.http.stop()
+    await openapi.http.stop()
+    await gateway.stop()
@@ -0,0 +1,187 @@
+"""
+End-to-end load test of `main.main()` against local fake services.
+
+    python -m benchmarks.loadtest --groups 20 --rate 50 --duration 30
+    python -m benchmarks.loadtest --save-baseline benchmarks/baseline.json
+    python -m benchmarks.loadtest --baseline benchmarks/baseline.json
+
+MongoDB is still required (`MONGODB_URI`, default localhost); the benchmark
+uses its own database and drops it afterwards.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+from pathlib import Path
+import resource
+import signal
+import sys
+import time
+
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from .fakes import FakeGemini, bot_environ, start_fakes, stop_fakes
+
+BENCHMARK_DATABASE = "paimeng-benchmark"
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_memory_mb() -> float:
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(args: argparse.Namespace) -> dict[str, float]:
+    gateway, openapi, gemini = await start_fakes(
+        FakeGemini(
+            latency=args.gemini_latency,
+            jitter=args.gemini_jitter,
+            error_rate=args.gemini_error_rate,
+            safety_rate=args.gemini_safety_rate,
+            seed=args.seed,
+        )
+    )
+    os.environ.update(bot_environ(openapi, gemini))
+    os.environ["MONGODB_DATABASE"] = BENCHMARK_DATABASE
+    os.environ.pop("GATEWAY_SESSION_FILE", None)
+    import main as bot
+
+    started = time.perf_counter()
+    bot_task = asyncio.create_task(bot.main())
+    await asyncio.wait_for(gateway.ready.wait(), 30)
+    assert gateway.ready_at is not None
+    time_to_ready = gateway.ready_at - started
+
+    total = int(args.rate * args.duration)
+    sent: dict[str, float] = {}
+    all_replied = asyncio.Event()
+
+    def on_reply(msg_id: str) -> None:
+        if len(openapi.replies) >= total:
+            all_replied.set()
+
+    openapi.on_reply = on_reply
+    interval = 1 / args.rate
+    groups = itertools.cycle(f"group-{i}" for i in range(args.groups))
+    begin = time.perf_counter()
+    for i in range(total):
+        if (delay := begin + i * interval - time.perf_counter()) > 0:
+            await asyncio.sleep(delay)
+        msg_id = f"message-{i}"
+        content = " /echo 你好" if i % 100 < args.echo_percent else " 你好呀派蒙"
+        sent[msg_id] = time.perf_counter()
+        await gateway.dispatch(
+            "GROUP_AT_MESSAGE_CREATE",
+            {
+                "id": msg_id,
+                "group_openid": next(groups),
+                "content": content,
+                "author": {"member_openid": f"member-{i % 97}"},
+                "attachments": [],
+            },
+        )
+    send_elapsed = time.perf_counter() - begin
+    try:
+        await asyncio.wait_for(all_replied.wait(), args.drain_timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Only {len(openapi.replies)}/{total} replies arrived")
+    elapsed = max(openapi.replies.values(), default=begin) - begin
+
+    signal.raise_signal(signal.SIGTERM)
+    await bot_task
+    await AsyncIOMotorClient(bot.MONGODB_URI).drop_database(BENCHMARK_DATABASE)
+    await stop_fakes(gateway, openapi, gemini)
+
+    latencies = [openapi.replies[m] - sent[m] for m in sent if m in openapi.replies]
+    return {
+        "sent": total,
+        "replied": len(latencies),
+        "send_seconds": send_elapsed,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p99": percentile(latencies, 0.99),
+        "time_to_ready": time_to_ready,
+        "peak_memory_mb": peak_memory_mb(),
+    }
+
+
+# metric -> whether bigger is better
+CHECKS = {
+    "throughput": True,
+    "p50": False,
+    "p99": False,
+    "peak_memory_mb": False,
+}
+
+
+def compare(
+    result: dict[str, float], baseline: dict[str, float], tolerance: float
+) -> list[str]:
+    failures = []
+    for name, bigger_is_better in CHECKS.items():
+        if name not in baseline:
+            continue
+        expected, actual = baseline[name], result[name]
+        if bigger_is_better:
+            regressed = actual < expected * (1 - tolerance)
+        else:
+            regressed = actual > expected * (1 + tolerance)
+        if regressed:
+            failures.append(f"{name}: {actual:.4f} vs baseline {expected:.4f}")
+    if result["replied"] < result["sent"]:
+        failures.append(f"replied: {result['replied']} of {result['sent']}")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=20, help="messages/s in total")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument(
+        "--echo-percent",
+        type=int,
+        default=20,
+        help="share of cheap /echo messages, the rest go to Gemini",
+    )
+    parser.add_argument("--gemini-latency", type=float, default=0.5)
+    parser.add_argument("--gemini-jitter", type=float, default=0.5)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-safety-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--baseline", type=Path, help="fail if worse than this")
+    parser.add_argument("--save-baseline", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+
+    if args.save_baseline is not None:
+        args.save_baseline.write_text(json.dumps(result, indent=2) + "\n")
+    if args.baseline is not None:
+        failures = compare(
+            result, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        for failure in failures:
+            print(f"REGRESSION {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
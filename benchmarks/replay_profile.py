@@ -0,0 +1,84 @@
+"""
+Replay recorded gateway frames through the dispatch path under cProfile.
+
+    python -m benchmarks.replay_profile data/frames/*.frames
+    python -m benchmarks.replay_profile --speed 1 --output dispatch.prof rec.frames
+
+The handlers only classify and match the command, so the profile covers
+JSON decoding, `CommandMatcher` and task scheduling without any network.
+For a sampling profiler run the same command under `py-spy record`.
+"""
+
+import argparse
+import asyncio
+import cProfile
+import os
+from pathlib import Path
+import pstats
+import sys
+import time
+
+from loguru import logger
+
+from qqgroupbot.core import Event
+from qqgroupbot.recorder import replay_events
+from qqgroupbot.tasks import TaskRegistry
+
+
+async def replay(paths: list[Path], speed: float | None) -> int:
+    os.environ.setdefault("BOT_ID", "replay")
+    os.environ.setdefault("BOT_TOKEN", "replay")
+    os.environ.setdefault("GEMINI_PRO_KEY", "replay")
+    from main import Commands, classify
+
+    async def handle(event: Event) -> None:
+        d = event.get("d", {})
+        classify(d.get("content", ""))
+        Commands(
+            d.get("content", ""),
+            group_openid=d.get("group_openid"),
+            message_id=d.get("id"),
+            event=event,
+        )
+
+    registry = TaskRegistry()
+    count = 0
+    async for event in replay_events(paths, speed=speed):
+        if event.get("t") == "GROUP_AT_MESSAGE_CREATE":
+            registry.spawn(handle(event))
+        count += 1
+    await registry.drain(60)
+    return count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("paths", nargs="+", type=Path)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=None,
+        help="replay at this multiple of the recorded timing (default: fastest)",
+    )
+    parser.add_argument("--output", type=Path, help="write pstats data here")
+    parser.add_argument("--top", type=int, default=30)
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    count = asyncio.run(replay(args.paths, args.speed))
+    profiler.disable()
+    elapsed = time.perf_counter() - started
+
+    print(f"Replayed {count} events in {elapsed:.3f}s ({count / elapsed:.0f}/s)")
+    if args.output is not None:
+        profiler.dump_stats(args.output)
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(args.top)
+
+
+if __name__ == "__main__":
+    main()
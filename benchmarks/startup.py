@@ -0,0 +1,92 @@
+"""
+Measure cold start: importing `main`, and `main()` until the gateway is READY.
+
+    python -m benchmarks.startup
+    USE_UVLOOP=1 python -m benchmarks.startup --runs 10
+
+Each run is a fresh interpreter so imports are really cold. MongoDB does not
+have to be reachable; the warm-up runs in the background and does not delay
+READY.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+from loguru import logger
+
+from .fakes import FakeGemini, bot_environ, start_fakes, stop_fakes
+
+
+async def measure_once() -> dict[str, float]:
+    gateway, openapi, gemini = await start_fakes(FakeGemini(latency=0))
+    os.environ.update(bot_environ(openapi, gemini))
+
+    started = time.perf_counter()
+    import main as bot
+
+    imported = time.perf_counter()
+    bot_task = asyncio.create_task(bot.main())
+    await asyncio.wait_for(gateway.ready.wait(), 30)
+    assert gateway.ready_at is not None
+
+    signal.raise_signal(signal.SIGTERM)
+    await bot_task
+    await stop_fakes(gateway, openapi, gemini)
+    return {
+        "import": imported - started,
+        "time_to_ready": gateway.ready_at - imported,
+        "total": gateway.ready_at - started,
+    }
+
+
+def run_once() -> None:
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    if os.environ.get("USE_UVLOOP"):
+        import uvloop
+
+        result = asyncio.run(measure_once(), loop_factory=uvloop.new_event_loop)
+    else:
+        result = asyncio.run(measure_once())
+    print(json.dumps(result))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--once", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.once:
+        run_once()
+        return
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.startup", "--once"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    summary = {
+        name: {
+            "median": statistics.median(result[name] for result in results),
+            "min": min(result[name] for result in results),
+        }
+        for name in results[0]
+    }
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,37 @@
 import asyncio
 import base64
+import contextlib
+import contextvars
 import datetime
 import os
-import random
-from typing import Any
+import re
+import signal
+from typing import TYPE_CHECKING, Any, Awaitable, Callable
 import httpx
 
 from loguru import logger
-from motor.motor_asyncio import AsyncIOMotorClient
-from bingimagecreator import ImageGen, GenerateImagePromptException
 
-from qqgroupbot.core import Event, initial_openapi_client, fetch_events, get_gateway_url
+from qqgroupbot.admission import AdmissionController, AdmissionRejected, Priority
+from qqgroupbot.archive import ArchiveWriter
+from qqgroupbot.bing import ImageGenPool, ImageGenUnavailable
+from qqgroupbot.core import (
+    Event,
+    GatewaySession,
+    initial_openapi_client,
+    fetch_events,
+    get_gateway_url,
+)
+from qqgroupbot.metrics import Gauge, STAGE_SECONDS, serve_metrics
+from qqgroupbot.profiling import LoopMonitor, SamplingProfiler
+from qqgroupbot.recorder import FrameRecorder
+from qqgroupbot.tasks import TaskRegistry
+from qqgroupbot.tracing import (
+    JsonlExporter,
+    OtlpHttpExporter,
+    initial_tracer,
+    span,
+    start_trace,
+)
 from qqgroupbot.apis.reply_group_message import reply_group_message
 from qqgroupbot.aichat.gemini import (
     generate_content,
@@ -21,9 +42,16 @@ from qqgroupbot.aichat.gemini import (
     Part as GeminiRequestPart,
     initial_gemini_client,
     is_supported_mime_type,
+    warm_up_gemini_client,
 )
 from qqgroupbot.command import command, CommandMatcher
 
+if TYPE_CHECKING:
+    from motor.motor_asyncio import AsyncIOMotorDatabase
+
+    from qqgroupbot.memory import GroupMemory
+    from qqgroupbot.semantic_cache import SemanticCache
+
 BOT_ID = os.environ["BOT_ID"]
 BOT_TOKEN = os.environ["BOT_TOKEN"]
 
@@ -33,27 +61,183 @@ AUTHORIZATION = f"Bot {BOT_ID}.{BOT_TOKEN}"
 GEMINI_PRO_KEY = os.environ["GEMINI_PRO_KEY"]
 GEMINI_PRO_URL = os.environ.get("GEMINI_PRO_URL")
 GEMINI_PRO_VISION_URL = os.environ.get("GEMINI_PRO_VISION_URL")
+GEMINI_EMBEDDING_URL = os.environ.get("GEMINI_EMBEDDING_URL")
 
 BING_COOKIES = os.environ.get("BING_COOKIES", "")
+BING_MAX_CONCURRENCY = int(os.environ.get("BING_MAX_CONCURRENCY", "2"))
+
+MONGODB_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
+MONGODB_DATABASE = os.environ.get("MONGODB_DATABASE", "paimeng")
+
+GATEWAY_SESSION_FILE = os.environ.get("GATEWAY_SESSION_FILE")
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "50"))
+GATEWAY_RECORD_DIR = os.environ.get("GATEWAY_RECORD_DIR")
+GATEWAY_RECORD_MAX_BYTES = int(os.environ.get("GATEWAY_RECORD_MAX_BYTES", "67108864"))
+
+REPLY_TIMEOUT = 5 * 60 - 5  # 5 minutes
+
+MEMORY_EMBEDDER = os.environ.get("MEMORY_EMBEDDER")  # "gemini" or "hashing"
+MEMORY_TOP_K = int(os.environ.get("MEMORY_TOP_K", "3"))
+MEMORY_MIN_SCORE = float(os.environ.get("MEMORY_MIN_SCORE", "0.75"))
+MEMORY_MAX_TURNS = int(os.environ.get("MEMORY_MAX_TURNS", "20000"))
+MEMORY_MAX_GROUPS = int(os.environ.get("MEMORY_MAX_GROUPS", "32"))
+# With memory enabled, continuous conversations only send this many recent turns
+CONVERSATION_RECENT_TURNS = int(os.environ.get("CONVERSATION_RECENT_TURNS", "10"))
+
+SEMANTIC_CACHE_EMBEDDER = os.environ.get("SEMANTIC_CACHE_EMBEDDER")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+SEMANTIC_CACHE_MAX_BYTES = int(os.environ.get("SEMANTIC_CACHE_MAX_BYTES", "67108864"))
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER")  # "jsonl" or "otlp"
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.environ.get(
+    "OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"
+)
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_THRESHOLD = float(os.environ.get("TRACE_SLOW_THRESHOLD", "10"))
+
+ADMIN_MEMBER_OPENIDS = frozenset(
+    filter(None, os.environ.get("ADMIN_MEMBER_OPENIDS", "").split(","))
+)
+SLOW_CALLBACK_THRESHOLD = float(os.environ.get("SLOW_CALLBACK_THRESHOLD", "0.25"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_MAX_SECONDS = 120
+
+handlers = TaskRegistry()
+profiler = SamplingProfiler(PROFILE_DIR)
+
+admission = AdmissionController(
+    int(os.environ.get("ADMISSION_CAPACITY", "1000")),
+    reserved=int(os.environ.get("ADMISSION_RESERVED", "100")),
+    queue_slo=float(os.environ.get("ADMISSION_QUEUE_SLO", "30")),
+    max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "2000")),
+)
+# Beyond this many handler tasks the dispatcher stops reading the gateway
+MAX_HANDLERS = int(
+    os.environ.get("MAX_HANDLERS", str(admission.capacity + admission.max_queue))
+)
 
 
 async def download_image(url: str) -> str:
-    async with httpx.AsyncClient() as client:
-        return base64.b64encode(await (await client.get(url)).aread()).decode()
+    with span("download_image", url=url), STAGE_SECONDS.labels("download_image").time():
+        async with httpx.AsyncClient() as client:
+            return base64.b64encode(await (await client.get(url)).aread()).decode()
+
+
+def split_cookies(cookies: str) -> list[str]:
+    """
+    Several cookies are separated by `|` or newlines
+    """
+    return [cookie.strip() for cookie in re.split(r"[|\n]", cookies) if cookie.strip()]
+
+
+bing_pool = ImageGenPool(
+    split_cookies(BING_COOKIES), max_concurrency=BING_MAX_CONCURRENCY
+)
 
 
 async def generate_image(prompt: str) -> str:
-    async with ImageGen(BING_COOKIES) as g:
-        links = await g.get_images(prompt)
-        logger.debug(f"Generated images: {links}")
-        # QQ 只能发 1 张图
-        return str(g.session._merge_url(random.choice(links)))
+    with span("generate_image"):
+        return await bing_pool.generate(prompt)
+
 
+MongoDatabase: contextvars.ContextVar["AsyncIOMotorDatabase"] = contextvars.ContextVar(
+    "MongoDatabase"
+)
+
+
+@contextlib.asynccontextmanager
+async def initial_mongo_client(uri: str, database: str):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(uri)
+    token = MongoDatabase.set(client[database])
+    try:
+        yield client
+    finally:
+        MongoDatabase.reset(token)
+        client.close()
 
-client = AsyncIOMotorClient(os.environ.get("MONGODB_URI", "mongodb://localhost:27017"))
-db = client["paimeng"]
-collection_messages = db["messages"]
-collection_multi_turn_conversations = db["turns_messages"]
+
+class TracedCollection:
+    """
+    Resolve the collection from `MongoDatabase` on use, and wrap every awaited
+    collection method in a tracing span
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __getattr__(self, attr: str) -> Callable[..., Awaitable[Any]]:
+        method = getattr(MongoDatabase.get()[self.name], attr)
+
+        async def traced(*args: Any, **kwargs: Any) -> Any:
+            with span(f"mongo.{attr}", collection=self.name):
+                return await method(*args, **kwargs)
+
+        return traced
+
+    def find(self, *args: Any, **kwargs: Any) -> Any:
+        # Cursors are iterated, not awaited
+        return MongoDatabase.get()[self.name].find(*args, **kwargs)
+
+
+collection_messages = TracedCollection("messages")
+collection_multi_turn_conversations = TracedCollection("turns_messages")
+collection_group_settings = TracedCollection("group_settings")
+
+archive = ArchiveWriter(
+    collection_messages,
+    batch_size=int(os.environ.get("ARCHIVE_BATCH_SIZE", "100")),
+    interval=float(os.environ.get("ARCHIVE_FLUSH_INTERVAL", "1")),
+    max_pending=int(os.environ.get("ARCHIVE_MAX_PENDING", "10000")),
+    spill_path=os.environ.get("ARCHIVE_SPILL_FILE", "archive-spill.jsonl"),
+    rejected_path=os.environ.get("ARCHIVE_REJECTED_FILE", "archive-rejected.jsonl"),
+    retry_interval=float(os.environ.get("ARCHIVE_SPILL_RETRY_INTERVAL", "60")),
+)
+
+memory: "GroupMemory | None" = None
+if MEMORY_EMBEDDER:
+    from qqgroupbot.memory import GeminiEmbedder, GroupMemory, HashingEmbedder
+
+    memory = GroupMemory(
+        GeminiEmbedder() if MEMORY_EMBEDDER == "gemini" else HashingEmbedder(),
+        collection_messages,
+        TracedCollection("memory_vectors"),
+        top_k=MEMORY_TOP_K,
+        min_score=MEMORY_MIN_SCORE,
+        max_turns=MEMORY_MAX_TURNS,
+        max_groups=MEMORY_MAX_GROUPS,
+    )
+
+semantic_cache: "SemanticCache | None" = None
+if SEMANTIC_CACHE_EMBEDDER:
+    from qqgroupbot.memory import GeminiEmbedder, HashingEmbedder
+    from qqgroupbot.semantic_cache import SemanticCache
+
+    semantic_cache = SemanticCache(
+        GeminiEmbedder() if SEMANTIC_CACHE_EMBEDDER == "gemini" else HashingEmbedder(),
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        max_bytes=SEMANTIC_CACHE_MAX_BYTES,
+    )
+
+# group_openid -> whether the group uses the semantic cache, read once per group
+semantic_cache_enabled: dict[str, bool] = {}
+
+
+async def is_semantic_cache_enabled(group_openid: str) -> bool:
+    if (enabled := semantic_cache_enabled.get(group_openid)) is None:
+        document = await collection_group_settings.find_one(
+            {"group_openid": group_openid}
+        )
+        enabled = (document or {}).get("semantic_cache", True)
+        semantic_cache_enabled[group_openid] = enabled
+    return enabled
 
 
 class Commands(CommandMatcher):
@@ -117,6 +301,8 @@ class Commands(CommandMatcher):
             )
             return
 
+        from bingimagecreator import GenerateImagePromptException
+
         parts: list[Any] = [
             {
                 "text": "Please generate accurate and detailed prompt for DALL-E based on the prompt words I gave. You only need to give me the prompt and do not give any additional content. I'll give you a big tip: "
@@ -141,6 +327,13 @@ class Commands(CommandMatcher):
                 [{"parts": parts}], safety_threshold="BLOCK_LOW_AND_ABOVE"
             )
             image_url = await generate_image(image_prompt)
+        except ImageGenUnavailable:
+            await reply_group_message(
+                group_openid=group_openid,
+                message_id=message_id,
+                content="派蒙的画笔都在休息，等一会儿再来吧。",
+            )
+            return
         except (GenerateImagePromptException, GenerateSafeError):
             await reply_group_message(
                 group_openid=group_openid,
@@ -178,6 +371,50 @@ class Commands(CommandMatcher):
                 image_url=image_url,
             )
 
+    @command("profile")
+    async def profile(
+        self,
+        content: str,
+        /,
+        *,
+        group_openid: str,
+        message_id: str,
+        event: Event,
+        **_: Any,
+    ) -> None:
+        member_openid = event.get("d", {}).get("author", {}).get("member_openid")
+        if member_openid not in ADMIN_MEMBER_OPENIDS:
+            await reply_group_message(
+                group_openid=group_openid,
+                message_id=message_id,
+                content="只有管理员可以使用这个命令。",
+            )
+            return
+
+        try:
+            seconds = float(content or 10)
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            await reply_group_message(
+                group_openid=group_openid,
+                message_id=message_id,
+                content=f"采样时长需要在 0 到 {PROFILE_MAX_SECONDS} 秒之间。",
+            )
+            return
+
+        try:
+            path = await profiler.profile(seconds)
+        except RuntimeError:
+            content = "已经在采样了，等它结束吧。"
+        else:
+            content = f"采样完成，结果保存在 {path}"
+        await reply_group_message(
+            group_openid=group_openid,
+            message_id=message_id,
+            content=content,
+        )
+
     @command("Bing cookies")
     async def bing_cookies(
         self,
@@ -188,17 +425,20 @@ class Commands(CommandMatcher):
         message_id: str,
         **_: Any,
     ) -> None:
-        global BING_COOKIES
-
         if not content:
             await reply_group_message(
                 group_openid=group_openid,
                 message_id=message_id,
-                content=BING_COOKIES,
+                content="\n".join(
+                    f"{prefix}… 进行中 {busy} 个"
+                    + (f"，暂停 {quarantine:.0f} 秒" if quarantine else "")
+                    for prefix, busy, quarantine in bing_pool.status()
+                )
+                or "没有设置 cookies。",
             )
             return
 
-        BING_COOKIES = content.strip()
+        await bing_pool.reload(split_cookies(content))
 
         await reply_group_message(
             group_openid=group_openid,
@@ -206,6 +446,32 @@ class Commands(CommandMatcher):
             content="好的，已经更新了。",
         )
 
+    @command("原神")
+    async def genshin(
+        self,
+        content: str,
+        /,
+        *,
+        group_openid: str,
+        message_id: str,
+        **_: Any,
+    ) -> None:
+        from ys.characters import load_characters
+
+        if not content.strip():
+            response_content = (
+                "可以问派蒙角色（名字、拼音或首字母）、材料，"
+                "或者元素、武器、星级的组合，比如“/原神 火 5星”。"
+            )
+        else:
+            answer = load_characters().answer(content)
+            response_content = answer or f"派蒙没有找到「{content.strip()}」。"
+        await reply_group_message(
+            group_openid=group_openid,
+            message_id=message_id,
+            content=response_content,
+        )
+
     @command("连续对话")
     async def start_conversation(
         self,
@@ -234,6 +500,39 @@ class Commands(CommandMatcher):
                 content="好的，我们来聊些什么呢？",
             )
 
+    @command("缓存")
+    async def semantic_cache_setting(
+        self,
+        content: str,
+        /,
+        *,
+        group_openid: str,
+        message_id: str,
+        **_: Any,
+    ) -> None:
+        if semantic_cache is None:
+            response_content = "没有启用回答缓存。"
+        elif content in ("开启", "关闭"):
+            enabled = content == "开启"
+            await collection_group_settings.update_one(
+                {"group_openid": group_openid},
+                {"$set": {"semantic_cache": enabled}},
+                upsert=True,
+            )
+            semantic_cache_enabled[group_openid] = enabled
+            response_content = f"好的，已经{content}回答缓存。"
+        else:
+            enabled = await is_semantic_cache_enabled(group_openid)
+            response_content = (
+                f"回答缓存已{'开启' if enabled else '关闭'}，"
+                "发送“/缓存 开启”或“/缓存 关闭”切换。"
+            )
+        await reply_group_message(
+            group_openid=group_openid,
+            message_id=message_id,
+            content=response_content,
+        )
+
     @command("结束对话")
     async def end_conversation(
         self,
@@ -247,7 +546,7 @@ class Commands(CommandMatcher):
         if document := await collection_multi_turn_conversations.find_one_and_delete(
             {"group_openid": group_openid}
         ):
-            await collection_messages.insert_one(
+            archive.put(
                 {
                     "group_openid": group_openid,
                     "contents": document["contents"],
@@ -291,16 +590,37 @@ class Commands(CommandMatcher):
                     }
                 )
         contents: list[GeminiRequestContent]
-        if document := await collection_multi_turn_conversations.find_one(
-            {"group_openid": group_openid}
-        ):
+        with STAGE_SECONDS.labels("mongo_find_one").time():
+            document = await collection_multi_turn_conversations.find_one(
+                {"group_openid": group_openid}
+            )
+        if document:
             contents = document["contents"]
             contents.append({"role": "user", "parts": parts})
         else:
-            contents = [{"parts": parts}]
+            contents = [{"role": "user", "parts": parts}]
+
+        prompt = contents
+        # Vision requests cannot carry history
+        if memory is not None and len(parts) == 1:
+            recent = contents[-2 * CONVERSATION_RECENT_TURNS - 1 :]
+            prompt = await memory.recall(group_openid, content, exclude=recent) + recent
 
         try:
-            response_content = await generate_content(contents)
+            # Only a bare one-shot question has the same answer everywhere
+            if (
+                semantic_cache is not None
+                and not document
+                and len(prompt) == 1
+                and len(parts) == 1
+                and content.strip()
+                and await is_semantic_cache_enabled(group_openid)
+            ):
+                response_content = await semantic_cache.get_or_generate(
+                    content, lambda: generate_content(prompt)
+                )
+            else:
+                response_content = await generate_content(prompt)
         except GenerateSafeError as error:
             response_content = "这是不可以谈的话题。"
             logger.warning(f"Safe error: {error}")
@@ -327,14 +647,14 @@ class Commands(CommandMatcher):
                     }
                 },
             )
+            contents.append(
+                {
+                    "role": "model",
+                    "parts": [{"text": response_content}],
+                },
+            )
             if update_result.modified_count == 0:
-                contents.append(
-                    {
-                        "role": "model",
-                        "parts": [{"text": response_content}],
-                    },
-                )
-                await collection_messages.insert_one(
+                archive.put(
                     {
                         "group_openid": group_openid,
                         "contents": contents,
@@ -346,6 +666,45 @@ class Commands(CommandMatcher):
             message_id=message_id,
             content=response_content,
         )
+        if memory is not None and contents[-1].get("role") == "model":
+            await memory.remember(group_openid, contents[-2:])
+
+
+ADMISSION_RUNNING = Gauge(
+    "qqgroupbot_admission_running",
+    "Handlers holding an admission slot",
+    ("priority",),
+)
+ADMISSION_CAPACITY = Gauge(
+    "qqgroupbot_admission_capacity",
+    "Admission slots usable by each priority",
+    ("priority",),
+)
+for priority in Priority:
+    ADMISSION_RUNNING.labels(priority.name.lower()).set_function(
+        lambda priority=priority: admission.running[priority]
+    )
+ADMISSION_CAPACITY.labels("cheap").set(admission.capacity)
+ADMISSION_CAPACITY.labels("expensive").set(admission.capacity - admission.reserved)
+Gauge(
+    "qqgroupbot_admission_queue_depth", "Handlers waiting for an admission slot"
+).set_function(lambda: admission.queue_depth)
+Gauge(
+    "qqgroupbot_admission_queue_delay_seconds", "Age of the oldest admission waiter"
+).set_function(lambda: admission.queue_delay)
+Gauge("qqgroupbot_handlers_in_flight", "Running handler tasks").set_function(
+    lambda: len(handlers)
+)
+Gauge(
+    "qqgroupbot_handlers_oldest_age_seconds", "Age of the oldest running handler"
+).set_function(lambda: max((age for _, age in handlers.in_flight()), default=0))
+
+EXPENSIVE_COMMANDS = frozenset(("", "draw"))  # "" is `unknown_command`
+
+
+def classify(content: str) -> Priority:
+    command, _ = Commands.match(content)
+    return Priority.EXPENSIVE if command in EXPENSIVE_COMMANDS else Priority.CHEAP
 
 
 async def group_at_message_create(event: Event):
@@ -356,49 +715,176 @@ async def group_at_message_create(event: Event):
     group_openid = event["d"]["group_openid"]
     content = event["d"]["content"]
     message_id = event["d"]["id"]
+    with start_trace(
+        "group_at_message_create", group_openid=group_openid, message_id=message_id
+    ):
+        await handle_message(content, group_openid, message_id, event)
+
+
+async def handle_message(
+    content: str, group_openid: str, message_id: str, event: Event
+) -> None:
     try:
-        await asyncio.wait_for(
-            Commands(
-                content, group_openid=group_openid, message_id=message_id, event=event
-            ),
-            5 * 60 - 5,  # 5 minutes
-        )
-    except asyncio.TimeoutError:
+        async with admission.admit(classify(content)) as waited:
+            try:
+                await asyncio.wait_for(
+                    Commands(
+                        content,
+                        group_openid=group_openid,
+                        message_id=message_id,
+                        event=event,
+                    ),
+                    REPLY_TIMEOUT - waited,
+                )
+            except asyncio.TimeoutError:
+                await reply_group_message(
+                    group_openid=group_openid,
+                    message_id=message_id,
+                    content="哎呀，派蒙思考太久了。",
+                )
+    except AdmissionRejected as error:
+        logger.warning(f"Shed message {message_id}: {error}")
         await reply_group_message(
             group_openid=group_openid,
             message_id=message_id,
-            content="哎呀，派蒙思考太久了。",
+            content="派蒙现在太忙了，等一会儿再来找我吧。",
         )
 
 
-async def main():
-    semaphore = asyncio.Semaphore(1000)
-
-    async with (
-        initial_openapi_client(BOT_URL, AUTHORIZATION),
-        initial_gemini_client(
-            GEMINI_PRO_KEY, pro_url=GEMINI_PRO_URL, pro_vision_url=GEMINI_PRO_VISION_URL
-        ),
+async def dispatch_events(
+    gateway_url: str,
+    session: GatewaySession,
+    recorder: FrameRecorder | None = None,
+) -> None:
+    async for event in fetch_events(
+        gateway_url,
+        authorization=AUTHORIZATION,
+        intents=0 | (1 << 0) | (1 << 1) | (1 << 12) | (1 << 25) | (1 << 30),
+        session=session,
+        recorder=recorder,
     ):
-        async for event in fetch_events(
-            await get_gateway_url(BOT_URL, AUTHORIZATION),
-            authorization=AUTHORIZATION,
-            intents=0 | (1 << 0) | (1 << 1) | (1 << 12) | (1 << 25) | (1 << 30),
-        ):
-            op = event["op"]
-            if op != 0:
-                logger.warning(f"Unexpected event: {event}")
-                continue
-
-            match event.get("t"):
-                case "GROUP_AT_MESSAGE_CREATE":
-                    await semaphore.acquire()
-                    task = asyncio.create_task(group_at_message_create(event))
-                    task.add_done_callback(
-                        lambda future: semaphore.release() or future.result()
-                    )
-                case _:
-                    logger.warning(f"Unhandled event: {event}")
+        op = event["op"]
+        if op != 0:
+            logger.warning(f"Unexpected event: {event}")
+            continue
+
+        match event.get("t"):
+            case "GROUP_AT_MESSAGE_CREATE":
+                handlers.spawn(
+                    group_at_message_create(event),
+                    name=f"message-{event.get('d', {}).get('id')}",
+                )
+            case _:
+                logger.warning(f"Unhandled event: {event}")
+        # Only after the event is spawned, so cancelling here loses nothing
+        await handlers.wait_below(MAX_HANDLERS)
+
+
+async def warm_up() -> None:
+    from ys.characters import load_characters
+
+    results = await asyncio.gather(
+        MongoDatabase.get().command("ping"),
+        warm_up_gemini_client(),
+        asyncio.to_thread(load_characters),
+        return_exceptions=True,
+    )
+    for name, result in zip(("MongoDB", "Gemini", "Genshin characters"), results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to warm up {name}: {result!r}")
+
+
+async def main():
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    session = (
+        GatewaySession.load(GATEWAY_SESSION_FILE)
+        if GATEWAY_SESSION_FILE
+        else GatewaySession()
+    )
+
+    async with contextlib.AsyncExitStack() as stack:
+        monitor = LoopMonitor(slow_threshold=SLOW_CALLBACK_THRESHOLD)
+        monitor.start()
+        stack.callback(monitor.stop)
+        if METRICS_PORT:
+            await stack.enter_async_context(
+                serve_metrics(METRICS_HOST, int(METRICS_PORT))
+            )
+        match TRACE_EXPORTER:
+            case "jsonl":
+                exporter = JsonlExporter(TRACE_FILE)
+            case "otlp":
+                exporter = OtlpHttpExporter(
+                    TRACE_OTLP_ENDPOINT, service_name="qq-paimeng"
+                )
+            case _:
+                exporter = None
+        if exporter is not None:
+            await stack.enter_async_context(
+                initial_tracer(
+                    exporter,
+                    sample_rate=TRACE_SAMPLE_RATE,
+                    slow_threshold=TRACE_SLOW_THRESHOLD,
+                )
+            )
+        bot_client = await stack.enter_async_context(
+            initial_openapi_client(BOT_URL, AUTHORIZATION)
+        )
+        # The rest of startup runs while this request is in flight
+        fetching_gateway_url = asyncio.create_task(
+            get_gateway_url(BOT_URL, AUTHORIZATION, client=bot_client)
+        )
+        stack.callback(fetching_gateway_url.cancel)
+        await stack.enter_async_context(
+            initial_gemini_client(
+                GEMINI_PRO_KEY,
+                pro_url=GEMINI_PRO_URL,
+                pro_vision_url=GEMINI_PRO_VISION_URL,
+                embedding_url=GEMINI_EMBEDDING_URL,
+            )
+        )
+        await stack.enter_async_context(
+            initial_mongo_client(MONGODB_URI, MONGODB_DATABASE)
+        )
+        stack.push_async_callback(bing_pool.close)
+        if memory is not None:
+            await memory.start()
+            stack.push_async_callback(memory.close)
+        # Flushed after handlers are drained and before the client closes
+        await archive.start()
+        stack.push_async_callback(archive.close)
+        # Open connection pools while the gateway connects
+        warming = asyncio.create_task(warm_up())
+        stack.callback(warming.cancel)
+        recorder = (
+            FrameRecorder(GATEWAY_RECORD_DIR, max_bytes=GATEWAY_RECORD_MAX_BYTES)
+            if GATEWAY_RECORD_DIR
+            else None
+        )
+        if recorder is not None:
+            stack.callback(recorder.close)
+        dispatcher = asyncio.create_task(
+            dispatch_events(await fetching_gateway_url, session, recorder)
+        )
+        stopped = asyncio.create_task(stopping.wait())
+        await asyncio.wait((dispatcher, stopped), return_when=asyncio.FIRST_COMPLETED)
+        # Stop taking new events, then let in-flight handlers finish
+        dispatcher.cancel()
+        stopped.cancel()
+        await asyncio.wait((dispatcher,))
+        logger.info("Stopped receiving events")
+        if cancelled := await handlers.drain(DRAIN_TIMEOUT):
+            logger.warning(f"Cancelled {cancelled} handlers after drain timeout")
+
+    if GATEWAY_SESSION_FILE and session.resumable:
+        session.dump(GATEWAY_SESSION_FILE)
+        logger.info(f"Saved gateway session to {GATEWAY_SESSION_FILE}")
+    if not dispatcher.cancelled():
+        dispatcher.result()  # Re-raise gateway errors after draining
 
 
 if __name__ == "__main__":
@@ -408,4 +894,9 @@ if __name__ == "__main__":
 
     logger.add(sys.stdout, level=os.environ.get("LOG_LEVEL", "INFO"))
 
-    asyncio.run(main())
+    if os.environ.get("USE_UVLOOP"):
+        import uvloop
+
+        asyncio.run(main(), loop_factory=uvloop.new_event_loop)
+    else:
+        asyncio.run(main())
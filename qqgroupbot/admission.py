@@ -0,0 +1,122 @@
+import asyncio
+from contextlib import asynccontextmanager
+import enum
+import time
+from typing import AsyncGenerator
+
+from loguru import logger
+
+from .metrics import Counter
+
+__all__ = ("Priority", "AdmissionRejected", "AdmissionController")
+
+ADMISSION_SHED = Counter(
+    "qqgroupbot_admission_shed", "Handlers shed by admission control"
+)
+
+
+class Priority(enum.IntEnum):
+    CHEAP = 0
+    EXPENSIVE = 1
+
+
+class AdmissionRejected(Exception):
+    """
+    Request was shed because the queue is too slow or too long
+    """
+
+    def __init__(self, waited: float) -> None:
+        self.waited = waited
+        super().__init__(f"Shed after waiting {waited:.3f}s")
+
+
+class AdmissionController:
+    """
+    Priority admission control for event handlers.
+
+    `capacity` handlers may run at once. `reserved` of those slots can only be
+    taken by cheap handlers, so expensive ones never use more than
+    `capacity - reserved`. Expensive handlers are shed once the oldest waiter
+    has been queued longer than `queue_slo` seconds, or once they themselves
+    have waited that long. Cheap handlers queue without a time limit, but any
+    handler is shed when `max_queue` handlers are already waiting.
+    """
+
+    def __init__(
+        self, capacity: int, *, reserved: int, queue_slo: float, max_queue: int
+    ) -> None:
+        if not 0 <= reserved < capacity:
+            raise ValueError("reserved must be in [0, capacity)")
+        self.capacity = capacity
+        self.reserved = reserved
+        self.queue_slo = queue_slo
+        self.max_queue = max_queue
+        self._total = asyncio.Semaphore(capacity)
+        self._expensive = asyncio.Semaphore(capacity - reserved)
+        self._waiting: dict[object, float] = {}
+        self.running = {Priority.CHEAP: 0, Priority.EXPENSIVE: 0}
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def queue_delay(self) -> float:
+        """
+        Age of the oldest waiter, in seconds
+        """
+        for started in self._waiting.values():
+            return time.monotonic() - started
+        return 0.0
+
+    async def _acquire(self, priority: Priority) -> None:
+        if priority is Priority.CHEAP:
+            await self._total.acquire()
+            return
+        await self._expensive.acquire()
+        try:
+            await self._total.acquire()
+        except BaseException:
+            self._expensive.release()
+            raise
+
+    def _release(self, priority: Priority) -> None:
+        self._total.release()
+        if priority is Priority.EXPENSIVE:
+            self._expensive.release()
+
+    @asynccontextmanager
+    async def admit(self, priority: Priority) -> AsyncGenerator[float, None]:
+        """
+        Wait for a slot, yielding the time spent waiting in seconds.
+        Raise `AdmissionRejected` if an expensive request is shed.
+        """
+        started = time.monotonic()
+        if self.queue_depth >= self.max_queue or (
+            priority is Priority.EXPENSIVE and self.queue_delay > self.queue_slo
+        ):
+            ADMISSION_SHED.inc()
+            raise AdmissionRejected(0.0)
+
+        key = object()
+        self._waiting[key] = started
+        try:
+            if priority is Priority.EXPENSIVE:
+                await asyncio.wait_for(self._acquire(priority), self.queue_slo)
+            else:
+                await self._acquire(priority)
+        except asyncio.TimeoutError:
+            ADMISSION_SHED.inc()
+            raise AdmissionRejected(time.monotonic() - started) from None
+        finally:
+            del self._waiting[key]
+
+        waited = time.monotonic() - started
+        if waited > 1:
+            logger.debug(f"Admitted {priority.name} after {waited:.3f}s")
+        self.running[priority] += 1
+        try:
+            yield waited
+        finally:
+            self.running[priority] -= 1
+            self._release(priority)
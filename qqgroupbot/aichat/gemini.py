@@ -5,7 +5,14 @@ from typing import Literal, TypedDict, NotRequired
 import httpx
 from loguru import logger
 
-from . import GenerateNetworkError, GenerateResponseError, GenerateSafeError
+from ..metrics import GEMINI_ERRORS, STAGE_SECONDS
+from ..tracing import span
+from . import (
+    GenerateClientError,
+    GenerateNetworkError,
+    GenerateResponseError,
+    GenerateSafeError,
+)
 
 
 def is_supported_mime_type(mime_type: str) -> bool:
@@ -29,8 +36,9 @@ async def initial_gemini_client(
     *,
     pro_url: str | None = None,
     pro_vision_url: str | None = None,
+    embedding_url: str | None = None,
 ):
-    global GEMINI_PRO_URL, GEMINI_PRO_VISION_URL
+    global GEMINI_PRO_URL, GEMINI_PRO_VISION_URL, GEMINI_EMBEDDING_URL
     GEMINI_PRO_URL = (
         "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
         if pro_url is None
@@ -41,6 +49,11 @@ async def initial_gemini_client(
         if pro_vision_url is None
         else pro_vision_url
     )
+    GEMINI_EMBEDDING_URL = (
+        "https://generativelanguage.googleapis.com/v1beta/models/embedding-001:batchEmbedContents"
+        if embedding_url is None
+        else embedding_url
+    )
 
     async with httpx.AsyncClient(params={"key": key}) as client:
         token = GeminiClient.set(client)
@@ -50,6 +63,13 @@ async def initial_gemini_client(
             GeminiClient.reset(token)
 
 
+async def warm_up_gemini_client() -> None:
+    """
+    Open a pooled connection to the Gemini endpoint before the first request
+    """
+    await GeminiClient.get().head(GEMINI_PRO_URL)
+
+
 class InlineData(TypedDict):
     data: str
     # image/png, image/jpeg, image/webp, image/heic, or image/heif
@@ -68,15 +88,34 @@ class Content(TypedDict):
     role: NotRequired[Literal["user", "model"]]
 
 
+SafetyThreshold = Literal[
+    "BLOCK_NONE",
+    "BLOCK_ONLY_HIGH",
+    "BLOCK_MEDIUM_AND_ABOVE",
+    "BLOCK_LOW_AND_ABOVE",
+]
+
+
 async def generate_content(
     contents: list[Content],
     *,
-    safety_threshold: Literal[
-        "BLOCK_NONE",
-        "BLOCK_ONLY_HIGH",
-        "BLOCK_MEDIUM_AND_ABOVE",
-        "BLOCK_LOW_AND_ABOVE",
-    ] = "BLOCK_NONE",
+    safety_threshold: SafetyThreshold = "BLOCK_NONE",
+) -> str:
+    try:
+        with (
+            span("gemini.generate_content", contents=len(contents)),
+            STAGE_SECONDS.labels("generate_content").time(),
+        ):
+            return await _generate_content(contents, safety_threshold=safety_threshold)
+    except GenerateClientError as error:
+        GEMINI_ERRORS.labels(type(error).__name__).inc()
+        raise
+
+
+async def _generate_content(
+    contents: list[Content],
+    *,
+    safety_threshold: SafetyThreshold,
 ) -> str:
     client = GeminiClient.get()
 
@@ -145,3 +184,48 @@ async def generate_content(
                 return text
             except KeyError:
                 raise GenerateResponseError("内部错误————嘎嘎————", resp)
+
+
+EmbeddingTaskType = Literal["RETRIEVAL_QUERY", "RETRIEVAL_DOCUMENT", "SEMANTIC_SIMILARITY"]
+
+
+async def embed_contents(
+    texts: list[str],
+    *,
+    task_type: EmbeddingTaskType = "RETRIEVAL_DOCUMENT",
+) -> list[list[float]]:
+    """
+    Embed every text in one `batchEmbedContents` request
+    """
+    client = GeminiClient.get()
+    # "https://.../models/embedding-001:batchEmbedContents" -> "models/embedding-001"
+    model = "models/" + GEMINI_EMBEDDING_URL.rsplit("/", 1)[-1].split(":", 1)[0]
+    try:
+        with (
+            span("gemini.embed_contents", texts=len(texts)),
+            STAGE_SECONDS.labels("embed_contents").time(),
+        ):
+            resp = await client.post(
+                GEMINI_EMBEDDING_URL,
+                json={
+                    "requests": [
+                        {
+                            "model": model,
+                            "content": {"parts": [{"text": text}]},
+                            "taskType": task_type,
+                        }
+                        for text in texts
+                    ]
+                },
+            )
+    except httpx.HTTPError as error:
+        GEMINI_ERRORS.labels(GenerateNetworkError.__name__).inc()
+        raise GenerateNetworkError(error)
+    response_json = resp.json()
+    if not resp.is_success:
+        GEMINI_ERRORS.labels(GenerateResponseError.__name__).inc()
+        raise GenerateResponseError(
+            response_json.get("error", {}).get("message", "内部错误————嘎嘎————"),
+            resp,
+        )
+    return [embedding["values"] for embedding in response_json["embeddings"]]
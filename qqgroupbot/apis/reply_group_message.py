@@ -3,6 +3,8 @@ import re
 from loguru import logger
 
 from ..core import BotClient
+from ..metrics import STAGE_SECONDS
+from ..tracing import span
 
 __all__ = ("reply_group_message",)
 
@@ -17,10 +19,11 @@ async def _reply_group_message(
     bot_client = BotClient.get()
 
     if image_url:
-        resp = await bot_client.post(
-            f"/v2/groups/{group_openid}/files",
-            json={"file_type": 1, "url": image_url, "srv_send_msg": False},
-        )
+        with span("openapi.upload_file"), STAGE_SECONDS.labels("reply_upload").time():
+            resp = await bot_client.post(
+                f"/v2/groups/{group_openid}/files",
+                json={"file_type": 1, "url": image_url, "srv_send_msg": False},
+            )
         upload_res = resp.json()
         try:
             file_info = upload_res["file_info"]
@@ -46,9 +49,10 @@ async def _reply_group_message(
         }
 
     logger.debug(f"Sending message to group {group_openid}: {request_json}")
-    resp = await bot_client.post(
-        f"/v2/groups/{group_openid}/messages", json=request_json
-    )
+    with span("openapi.send_message"), STAGE_SECONDS.labels("reply_send").time():
+        resp = await bot_client.post(
+            f"/v2/groups/{group_openid}/messages", json=request_json
+        )
     if not resp.is_success:
         logger.warning(f"Failed to send message: {resp.text}")
     else:
@@ -0,0 +1,212 @@
+import asyncio
+import collections
+import time
+from pathlib import Path
+from typing import Any, Protocol
+
+from loguru import logger
+
+from .metrics import Counter, Gauge, STAGE_SECONDS
+
+__all__ = ("ArchiveWriter",)
+
+ARCHIVE_PENDING = Gauge(
+    "qqgroupbot_archive_pending", "Documents waiting to be archived"
+)
+ARCHIVE_WRITTEN = Counter(
+    "qqgroupbot_archive_written", "Documents written by the archive writer"
+)
+ARCHIVE_SPILLED = Counter(
+    "qqgroupbot_archive_spilled", "Documents spilled to disk instead of MongoDB"
+)
+ARCHIVE_REJECTED = Counter(
+    "qqgroupbot_archive_rejected", "Documents MongoDB can never write"
+)
+
+DUPLICATE_KEY = 11000
+# Write errors worth retrying: interruptions, elections and timeouts
+RETRYABLE_CODES = frozenset(
+    {6, 7, 50, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+)
+
+
+class Collection(Protocol):
+    async def insert_many(self, documents: list[Any], *, ordered: bool) -> Any:
+        ...
+
+
+class ArchiveWriter:
+    """
+    Write-behind archival. Handlers `put` documents without waiting, and a
+    background task inserts them with `insert_many(ordered=False)` once
+    `batch_size` are pending or every `interval` seconds.
+
+    At most `max_pending` documents are kept in memory. Beyond that, and for
+    documents MongoDB fails to write for a transient reason, documents are
+    appended to `spill_path` and loaded back when the writer starts and every
+    `retry_interval` seconds. Documents keep the `_id` assigned on the first
+    attempt and duplicate key errors count as written, so re-inserting is
+    idempotent. Documents that cannot be encoded or that MongoDB rejects for
+    good go to `rejected_path` and are never retried.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        *,
+        batch_size: int = 100,
+        interval: float = 1.0,
+        max_pending: int = 10000,
+        spill_path: str | Path | None = None,
+        rejected_path: str | Path | None = None,
+        retry_interval: float = 60.0,
+    ) -> None:
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.spill_path = None if spill_path is None else Path(spill_path)
+        self.rejected_path = None if rejected_path is None else Path(rejected_path)
+        self.retry_interval = retry_interval
+        self.pending: collections.deque[dict[str, Any]] = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task: asyncio.Task[None] | None = None
+        ARCHIVE_PENDING.set_function(lambda: len(self.pending))
+
+    def put(self, document: dict[str, Any]) -> None:
+        if len(self.pending) >= self.max_pending:
+            self._spill([document])
+            return
+        self.pending.append(document)
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    @staticmethod
+    def _append(path: Path | None, documents: list[dict[str, Any]]) -> bool:
+        if path is None:
+            logger.error(f"Dropped {len(documents)} archive documents")
+            return False
+        from bson import json_util
+
+        with open(path, "a", encoding="utf-8") as file:
+            for document in documents:
+                try:
+                    line = json_util.dumps(document, ensure_ascii=False)
+                except Exception:
+                    logger.exception("Dropped an archive document")
+                    continue
+                file.write(line + "\n")
+        return True
+
+    def _spill(self, documents: list[dict[str, Any]]) -> None:
+        ARCHIVE_SPILLED.inc(len(documents))
+        if self._append(self.spill_path, documents):
+            logger.warning(f"Spilled {len(documents)} archive documents")
+
+    def _reject(self, documents: list[dict[str, Any]]) -> None:
+        ARCHIVE_REJECTED.inc(len(documents))
+        if self._append(self.rejected_path, documents):
+            logger.error(
+                f"Moved {len(documents)} archive documents to {self.rejected_path}"
+            )
+
+    def _load_spilled(self) -> None:
+        if self.spill_path is None or not self.spill_path.exists():
+            return
+        from bson import json_util
+
+        spilled = self.spill_path.read_text(encoding="utf-8").splitlines()
+        self.spill_path.unlink()
+        for line in spilled:
+            if line:
+                self.put(json_util.loads(line))
+        logger.info(f"Loaded {len(spilled)} spilled archive documents")
+
+    async def _insert(
+        self, batch: list[dict[str, Any]]
+    ) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+        """
+        Insert `batch` and return the documents to retry and the documents
+        that can never be written
+        """
+        from pymongo.errors import BulkWriteError, InvalidDocument
+
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as error:
+            retry, rejected = [], []
+            for write_error in error.details.get("writeErrors", []):
+                code = write_error.get("code")
+                if code == DUPLICATE_KEY:
+                    continue
+                document = batch[write_error["index"]]
+                if code in RETRYABLE_CODES:
+                    retry.append(document)
+                else:
+                    logger.error(f"MongoDB rejected archive document: {write_error}")
+                    rejected.append(document)
+            return retry, rejected
+        except InvalidDocument:
+            # Raised before anything is sent, find the culprits one by one
+            if len(batch) == 1:
+                logger.exception("Failed to encode archive document")
+                return [], batch
+            retry, rejected = [], []
+            for document in batch:
+                document_retry, document_rejected = await self._insert([document])
+                retry += document_retry
+                rejected += document_rejected
+            return retry, rejected
+        return [], []
+
+    async def flush(self) -> None:
+        while self.pending:
+            batch = [
+                self.pending.popleft()
+                for _ in range(min(self.batch_size, len(self.pending)))
+            ]
+            try:
+                with STAGE_SECONDS.labels("archive_flush").time():
+                    retry, rejected = await self._insert(batch)
+            except Exception:
+                logger.exception(f"Failed to archive {len(batch)} documents")
+                self._spill(batch)
+                return
+            if retry:
+                logger.warning(f"MongoDB failed {len(retry)} archive documents")
+                self._spill(retry)
+            if rejected:
+                self._reject(rejected)
+            ARCHIVE_WRITTEN.inc(len(batch) - len(retry) - len(rejected))
+
+    async def _run(self) -> None:
+        retry_at = time.monotonic() + self.retry_interval
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if time.monotonic() >= retry_at:
+                retry_at = time.monotonic() + self.retry_interval
+                self._load_spilled()
+        await self.flush()
+        # Whatever could not be written now survives until the next start
+        if self.pending:
+            self._spill(list(self.pending))
+            self.pending.clear()
+
+    async def start(self) -> None:
+        self._load_spilled()
+        self._task = asyncio.create_task(self._run(), name="archive-writer")
+
+    async def close(self) -> None:
+        """
+        Flush everything still pending and stop the background task
+        """
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
@@ -0,0 +1,193 @@
+import asyncio
+import random
+import time
+from typing import Any, Iterable
+
+from loguru import logger
+
+from .metrics import Counter, Gauge
+
+__all__ = ("ImageGenPool", "ImageGenUnavailable")
+
+BING_SESSIONS = Gauge(
+    "qqgroupbot_bing_sessions", "Bing image sessions by state", ("state",)
+)
+BING_SESSION_FAILURES = Counter(
+    "qqgroupbot_bing_session_failures", "Bing image requests that quarantined a session"
+)
+
+
+class ImageGenUnavailable(Exception):
+    """
+    Every Bing session is quarantined
+    """
+
+
+class _Session:
+    def __init__(self, cookies: str) -> None:
+        self.cookies = cookies
+        self.image_gen: Any = None
+        # Requests sharing the session must not each open an ImageGen
+        self._opening = asyncio.Lock()
+        self.busy = 0
+        self.failures = 0
+        self.quarantined_until = 0.0
+        self.retired = False
+
+    @property
+    def healthy(self) -> bool:
+        return self.quarantined_until <= time.monotonic()
+
+    async def open(self) -> Any:
+        async with self._opening:
+            if self.image_gen is None:
+                from bingimagecreator import ImageGen
+
+                image_gen = ImageGen(self.cookies)
+                await image_gen.__aenter__()
+                self.image_gen = image_gen
+            return self.image_gen
+
+    async def close(self) -> None:
+        image_gen, self.image_gen = self.image_gen, None
+        if image_gen is not None:
+            try:
+                await image_gen.__aexit__(None, None, None)
+            except Exception:
+                logger.exception("Failed to close Bing session")
+
+
+class ImageGenPool:
+    """
+    Long-lived Bing ImageGen sessions, one per cookie.
+
+    Each request goes to the least busy healthy session, and every session
+    runs at most `max_concurrency` requests at once. A session whose request
+    fails is closed and quarantined for `quarantine` seconds, doubling with
+    each consecutive failure up to `max_quarantine`; it is tried again once
+    that has passed. `reload` swaps the cookie list without interrupting
+    requests already running on removed sessions.
+    """
+
+    def __init__(
+        self,
+        cookies: Iterable[str],
+        *,
+        max_concurrency: int = 2,
+        quarantine: float = 60,
+        max_quarantine: float = 3600,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.quarantine = quarantine
+        self.max_quarantine = max_quarantine
+        self.sessions: dict[str, _Session] = {
+            cookie: _Session(cookie) for cookie in dict.fromkeys(cookies) if cookie
+        }
+        self._released = asyncio.Condition()
+        BING_SESSIONS.labels("healthy").set_function(
+            lambda: sum(session.healthy for session in self.sessions.values())
+        )
+        BING_SESSIONS.labels("quarantined").set_function(
+            lambda: sum(not session.healthy for session in self.sessions.values())
+        )
+
+    def _pick(self) -> _Session | None:
+        """
+        Return the least busy healthy session with spare capacity, `None` if
+        all healthy sessions are full. Raise if none is healthy.
+        """
+        healthy = [session for session in self.sessions.values() if session.healthy]
+        if not healthy:
+            raise ImageGenUnavailable("No healthy Bing session")
+        session = min(healthy, key=lambda session: session.busy)
+        return session if session.busy < self.max_concurrency else None
+
+    async def _acquire(self) -> _Session:
+        async with self._released:
+            try:
+                while (session := self._pick()) is None:
+                    await self._released.wait()
+            except ImageGenUnavailable:
+                # Every other waiter would fail the same way, don't leave them asleep
+                self._released.notify_all()
+                raise
+            session.busy += 1
+            return session
+
+    async def _release(self, session: _Session) -> None:
+        session.busy -= 1
+        healthy = session.healthy
+        if session.busy == 0 and (session.retired or not healthy):
+            await session.close()
+        async with self._released:
+            if healthy:
+                self._released.notify()
+            else:
+                self._released.notify_all()
+
+    def _quarantine(self, session: _Session) -> float:
+        session.failures += 1
+        seconds = min(
+            self.quarantine * 2 ** (session.failures - 1), self.max_quarantine
+        )
+        session.quarantined_until = time.monotonic() + seconds
+        BING_SESSION_FAILURES.inc()
+        return seconds
+
+    async def generate(self, prompt: str) -> str:
+        """
+        Generate images for `prompt` and return the URL of one of them
+        """
+        from bingimagecreator import GenerateImagePromptException
+
+        session = await self._acquire()
+        try:
+            image_gen = await session.open()
+            links = await image_gen.get_images(prompt)
+        except GenerateImagePromptException:
+            raise
+        except Exception as error:
+            seconds = self._quarantine(session)
+            logger.warning(
+                f"Quarantine Bing session {session.cookies[:8]}… for {seconds}s:"
+                f" {error!r}"
+            )
+            raise
+        else:
+            session.failures = 0
+            logger.debug(f"Generated images: {links}")
+            # QQ 只能发 1 张图
+            return str(image_gen.session._merge_url(random.choice(links)))
+        finally:
+            await self._release(session)
+
+    async def reload(self, cookies: Iterable[str]) -> None:
+        """
+        Replace the cookie list. Sessions for unchanged cookies are kept,
+        removed ones close after their running requests finish.
+        """
+        cookies = [cookie for cookie in dict.fromkeys(cookies) if cookie]
+        sessions = {}
+        for cookie in cookies:
+            sessions[cookie] = self.sessions.pop(cookie, None) or _Session(cookie)
+        for session in self.sessions.values():
+            session.retired = True
+            if session.busy == 0:
+                await session.close()
+        self.sessions = sessions
+        async with self._released:
+            self._released.notify_all()
+
+    def status(self) -> list[tuple[str, int, float]]:
+        """
+        Cookie prefix, running requests and remaining quarantine per session
+        """
+        now = time.monotonic()
+        return [
+            (cookie[:8], session.busy, max(0.0, session.quarantined_until - now))
+            for cookie, session in self.sessions.items()
+        ]
+
+    async def close(self) -> None:
+        for session in self.sessions.values():
+            await session.close()
@@ -4,6 +4,10 @@ from typing import Any, Callable
 
 from loguru import logger
 
+from .metrics import STAGE_SECONDS
+
+_match_seconds = STAGE_SECONDS.labels("command_match")
+
 
 def command[C: Callable](name: str) -> Callable[[C], C]:
     def wrapper(func: C) -> C:
@@ -37,7 +41,8 @@ class CommandMatcher(abc.ABC):
         return cls.commands[match.group(1)], match.group(2)
 
     def __init__(self, content: str, **kwargs: Any) -> None:
-        self.command, self.content = self.match(content)
+        with _match_seconds.time():
+            self.command, self.content = self.match(content)
         logger.debug(f"Matched command: {self.command}")
         self.kwargs = kwargs
         self.run = getattr(self, self.command, self.unknown_command)
@@ -2,12 +2,19 @@ import asyncio
 from contextlib import asynccontextmanager
 import contextvars
 import json
-from typing import Any, AsyncGenerator, TypedDict, Required
+from pathlib import Path
+import time
+from typing import TYPE_CHECKING, Any, AsyncGenerator, TypedDict, Required
 
 import httpx
 from loguru import logger
 import websockets
 
+from .metrics import GATEWAY_RECONNECTS, STAGE_SECONDS
+
+if TYPE_CHECKING:
+    from .recorder import FrameRecorder
+
 BotClient: contextvars.ContextVar[httpx.AsyncClient] = contextvars.ContextVar(
     "BotClient"
 )
@@ -28,7 +35,15 @@ async def initial_openapi_client(bot_url: str, authorization: str):
             BotClient.reset(token)
 
 
-async def get_gateway_url(bot_url: str, authorization: str) -> str:
+async def get_gateway_url(
+    bot_url: str, authorization: str, *, client: httpx.AsyncClient | None = None
+) -> str:
+    """
+    Pass the long-lived OpenAPI client to reuse its connection pool
+    """
+    if client is not None:
+        resp = await client.get("/gateway")
+        return resp.json()["url"]
     async with initial_openapi_client(bot_url, authorization) as client:
         resp = await client.get("/gateway")
         return resp.json()["url"]
@@ -41,22 +56,62 @@ class Event(TypedDict, total=False):
     d: dict[str, Any]
 
 
+class GatewaySession:
+    """
+    Resumable gateway session, kept up to date while connected. `seq` is the
+    last event handed to the consumer, so resuming replays every event that
+    was received but not yet dispatched.
+    """
+
+    def __init__(self, session_id: str | None = None, seq: int | None = None) -> None:
+        self.session_id = session_id
+        self.seq = seq
+
+    @property
+    def resumable(self) -> bool:
+        return self.session_id is not None and self.seq is not None
+
+    def clear(self) -> None:
+        self.session_id = self.seq = None
+
+    def dump(self, path: str | Path) -> None:
+        Path(path).write_text(
+            json.dumps({"session_id": self.session_id, "seq": self.seq})
+        )
+
+    @classmethod
+    def load(cls, path: str | Path) -> "GatewaySession":
+        try:
+            data = json.loads(Path(path).read_text())
+        except (OSError, ValueError):
+            return cls()
+        return cls(data.get("session_id"), data.get("seq"))
+
+
 async def wss_connect(
     wss_url: str,
     authorization: str,
     intents: int,
     shard: tuple[int, int],
-    resume: tuple[str, int] | None = None,
-) -> AsyncGenerator[tuple[str, int] | Event, None]:
-    queue = asyncio.Queue(1)
-    seq: int | None
+    session: GatewaySession,
+    recorder: "FrameRecorder | None" = None,
+) -> AsyncGenerator[Event, None]:
+    queue: asyncio.Queue[tuple[Event, float]] = asyncio.Queue(1)
+    receive_seconds = STAGE_SECONDS.labels("gateway_receive")
 
     async with websockets.connect(wss_url) as websocket:
-        data = await websocket.recv()
-        logger.debug(f"Receive: {data}")
+
+        async def receive() -> str | bytes:
+            data = await websocket.recv()
+            if recorder is not None:
+                recorder.record(data)
+            logger.debug(f"Receive: {data}")
+            return data
+
+        data = await receive()
         event = json.loads(data)
         heartbeat_interval = event["d"]["heartbeat_interval"]
-        if resume is None:
+        if not session.resumable:
             logger.info("Identify")
             data = json.dumps(
                 {
@@ -71,23 +126,22 @@ async def wss_connect(
             )
             logger.debug(f"Send: {data}")
             await websocket.send(data)
-            data = await websocket.recv()
+            data = await receive()
             event = json.loads(data)
             if event.get("t") != "READY":
                 logger.warning(f"Unexpected event: {event}")
                 return
-            seq = event.get("s")
-            session_id = event["d"]["session_id"]
+            session.seq = event.get("s")
+            session.session_id = event["d"]["session_id"]
         else:
-            logger.info(f"Resume: {resume}")
-            session_id, seq = resume
+            logger.info(f"Resume: {(session.session_id, session.seq)}")
             data = json.dumps(
                 {
                     "op": 6,
                     "d": {
                         "token": authorization,
-                        "session_id": session_id,
-                        "seq": seq,
+                        "session_id": session.session_id,
+                        "seq": session.seq,
                     },
                 }
             )
@@ -95,23 +149,26 @@ async def wss_connect(
             await websocket.send(data)
 
         stop = False
+        # Heartbeats carry the last received seq, the session only advances
+        # when an event is yielded
+        received_seq = session.seq
 
         async def heartbeat():
             while True:
-                await websocket.send(json.dumps({"op": 1, "d": seq}))
-                logger.debug(f"Heartbeat: {seq}")
+                await websocket.send(json.dumps({"op": 1, "d": received_seq}))
+                logger.debug(f"Heartbeat: {received_seq}")
                 await asyncio.sleep(heartbeat_interval / 1000)
 
         async def fetch_event():
-            nonlocal seq, stop
+            nonlocal stop, received_seq
 
             while True:
-                data = await websocket.recv()
-                logger.debug(f"Receive: {data}")
+                data = await receive()
+                received_at = time.perf_counter()
                 assert isinstance(data, str)
                 event: Event = json.loads(data)
                 if (s := event.get("s")) is not None:
-                    seq = s
+                    received_seq = s
                 op = event["op"]
                 if op == 0 and event.get("t") == "RESUMED":
                     continue
@@ -121,7 +178,12 @@ async def wss_connect(
                     stop = True
                     logger.info(f"Reconnect: {event}")
                     return
-                await queue.put(event)
+                if op == 9:  # Invalid Session
+                    stop = True
+                    session.clear()
+                    logger.info(f"Invalid session: {event}")
+                    return
+                await queue.put((event, received_at))
 
         heartbeat_task = asyncio.create_task(heartbeat())
         fetch_event_task = asyncio.create_task(fetch_event())
@@ -130,24 +192,28 @@ async def wss_connect(
             nonlocal stop
             stop = True
 
-        heartbeat_task.add_done_callback(lambda f: set_stop() or f.result())
-        fetch_event_task.add_done_callback(lambda f: set_stop() or f.result())
+        heartbeat_task.add_done_callback(lambda f: set_stop())
+        fetch_event_task.add_done_callback(lambda f: set_stop())
 
         try:
             while not stop or not queue.empty():
                 try:
-                    yield queue.get_nowait()
+                    event, received_at = queue.get_nowait()
                 except asyncio.QueueEmpty:
                     await asyncio.sleep(0.1)
+                else:
+                    receive_seconds.observe(time.perf_counter() - received_at)
+                    if (s := event.get("s")) is not None:
+                        session.seq = s
+                    yield event
         finally:
-            done, pending = await asyncio.wait(
-                [heartbeat_task, fetch_event_task],
-                return_when=asyncio.FIRST_COMPLETED,
-            )
-            [task.cancel() for task in pending]
-            [task.result() for task in done]
-            if seq is not None:
-                yield session_id, seq
+            heartbeat_task.cancel()
+            fetch_event_task.cancel()
+            for result in await asyncio.gather(
+                heartbeat_task, fetch_event_task, return_exceptions=True
+            ):
+                if not isinstance(result, (type(None), asyncio.CancelledError)):
+                    raise result
 
 
 async def fetch_events(
@@ -155,14 +221,21 @@ async def fetch_events(
     authorization: str,
     intents: int,
     shard: tuple[int, int] = (0, 1),
+    session: GatewaySession | None = None,
+    recorder: "FrameRecorder | None" = None,
 ) -> AsyncGenerator[Event, None]:
-    events = wss_connect(wss_url, authorization, intents, shard)
+    """
+    Yield dispatch events forever, resuming `session` on every reconnect.
+    Pass a loaded session to resume one checkpointed by a previous process,
+    and a recorder to keep every received frame for offline replay.
+    """
+    if session is None:
+        session = GatewaySession()
     while True:
-        async for event in events:
-            match event:
-                case (session_id, seq):
-                    events = wss_connect(
-                        wss_url, authorization, intents, shard, (session_id, seq)
-                    )
-                case _:
-                    yield event
+        async for event in wss_connect(
+            wss_url, authorization, intents, shard, session, recorder
+        ):
+            yield event
+        GATEWAY_RECONNECTS.inc()
+        if not session.resumable:
+            await asyncio.sleep(1)
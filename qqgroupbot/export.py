@@ -0,0 +1,293 @@
+"""
+Stream archived conversations out of MongoDB for offline analysis.
+
+    python -m qqgroupbot.export messages.jsonl.gz --since 2024-01-01
+    python -m qqgroupbot.export history --format parquet --strip-inline-data \\
+        --group GROUP_OPENID --checkpoint history.checkpoint.json
+
+Documents are read in `_id` order with a batched cursor and written one batch
+at a time, so memory stays flat however large the collection is. With
+`--checkpoint` the last exported `_id` and where the output ended are saved
+after every batch, and the next run cuts off anything written after that
+point before continuing, so a crash mid-batch never leaves the output
+unreadable or with duplicates. Without a checkpoint to resume from, an
+existing output is refused unless `--overwrite` is given.
+"""
+
+import argparse
+import asyncio
+import datetime
+import gzip
+import json
+import os
+from pathlib import Path
+from typing import Any, Iterable, Protocol
+
+from loguru import logger
+
+__all__ = ("export_messages", "strip_inline_data")
+
+
+def strip_inline_data(document: dict[str, Any]) -> dict[str, Any]:
+    """
+    Replace inline image data with its size, keeping the mime type
+    """
+    for content in document.get("contents", []):
+        for part in content.get("parts", []):
+            if inline_data := part.get("inline_data"):
+                part["inline_data"] = {
+                    "mime_type": inline_data.get("mime_type"),
+                    "size": len(inline_data.get("data") or ""),
+                }
+    return document
+
+
+class Writer(Protocol):
+    def write(self, documents: list[dict[str, Any]]) -> None:
+        ...
+
+    def position(self) -> int:
+        """
+        Where the output ends, to be passed back as `resume_at` on resume
+        """
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class JsonlWriter:
+    """
+    Gzip-compressed JSON lines in MongoDB relaxed extended JSON. Every batch
+    is a separate gzip member and the position is the file size, so a resumed
+    run truncates a partly written member and appends after the last whole one.
+    """
+
+    def __init__(self, path: Path, *, resume_at: int | None = None) -> None:
+        from bson import json_util
+
+        self.json_util = json_util
+        if resume_at is None:
+            self.file = open(path, "wb")
+        else:
+            self.file = open(path, "r+b")
+            self.file.truncate(resume_at)
+            self.file.seek(resume_at)
+
+    def write(self, documents: list[dict[str, Any]]) -> None:
+        lines = "".join(
+            self.json_util.dumps(document, ensure_ascii=False) + "\n"
+            for document in documents
+        )
+        self.file.write(gzip.compress(lines.encode()))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def position(self) -> int:
+        return self.file.tell()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    One Parquet file per batch inside the output directory, written under a
+    temporary name and renamed once its footer is on disk, so every part is
+    readable. `contents` is stored as a JSON string. The position is the
+    number of parts; a resumed run removes parts after it. Requires pyarrow.
+    """
+
+    def __init__(self, directory: Path, *, resume_at: int | None = None) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        self.part = resume_at or 0
+        for path in directory.glob("part-*.parquet.tmp"):
+            path.unlink()
+        for path in directory.glob("part-*.parquet"):
+            if int(path.name.split(".")[0].removeprefix("part-")) >= self.part:
+                path.unlink()
+        self.pa = pa
+        self.pq = pq
+        self.schema = pa.schema(
+            [
+                ("_id", pa.string()),
+                ("group_openid", pa.string()),
+                ("created_at", pa.timestamp("ms")),
+                ("contents", pa.string()),
+            ]
+        )
+
+    def write(self, documents: list[dict[str, Any]]) -> None:
+        columns = {
+            "_id": [str(document["_id"]) for document in documents],
+            "group_openid": [document.get("group_openid") for document in documents],
+            "created_at": [document.get("created_at") for document in documents],
+            "contents": [
+                json.dumps(document.get("contents", []), ensure_ascii=False)
+                for document in documents
+            ],
+        }
+        path = self.directory / f"part-{self.part:05d}.parquet"
+        temporary = path.with_suffix(".parquet.tmp")
+        with open(temporary, "wb") as file:
+            self.pq.write_table(
+                self.pa.table(columns, schema=self.schema), file, compression="zstd"
+            )
+            file.flush()
+            os.fsync(file.fileno())
+        temporary.replace(path)
+        self.part += 1
+
+    def position(self) -> int:
+        return self.part
+
+    def close(self) -> None:
+        pass
+
+
+def _load_checkpoint(path: Path | None) -> tuple[Any, int, int | None]:
+    """
+    Last exported `_id`, documents exported so far and the writer position
+    """
+    if path is None or not path.exists():
+        return None, 0, None
+    from bson import ObjectId
+
+    data = json.loads(path.read_text())
+    return ObjectId(data["last_id"]), data["count"], data["position"]
+
+
+def _save_checkpoint(path: Path, last_id: Any, count: int, position: int) -> None:
+    temporary = path.with_suffix(path.suffix + ".tmp")
+    temporary.write_text(
+        json.dumps({"last_id": str(last_id), "count": count, "position": position})
+    )
+    temporary.replace(path)
+
+
+async def export_messages(
+    collection: Any,
+    writer: Writer,
+    *,
+    group_openids: Iterable[str] = (),
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+    batch_size: int = 1000,
+    strip: bool = False,
+    checkpoint: Path | None = None,
+) -> int:
+    """
+    Export matching documents from a Motor collection and return how many
+    were written in this run. When resuming, `writer` must have been opened
+    at the position saved in `checkpoint`.
+    """
+    query: dict[str, Any] = {}
+    if group_openids := list(group_openids):
+        query["group_openid"] = {"$in": group_openids}
+    if since is not None or until is not None:
+        query["created_at"] = {}
+        if since is not None:
+            query["created_at"]["$gte"] = since
+        if until is not None:
+            query["created_at"]["$lt"] = until
+    last_id, previous, _ = _load_checkpoint(checkpoint)
+    if last_id is not None:
+        logger.info(f"Resuming after {last_id}, {previous} documents exported")
+        query["_id"] = {"$gt": last_id}
+
+    cursor = collection.find(query, sort=[("_id", 1)], batch_size=batch_size)
+    count = 0
+    batch: list[dict[str, Any]] = []
+    async for document in cursor:
+        batch.append(strip_inline_data(document) if strip else document)
+        if len(batch) < batch_size:
+            continue
+        count += _write_batch(writer, batch, checkpoint, previous + count)
+        batch = []
+    if batch:
+        count += _write_batch(writer, batch, checkpoint, previous + count)
+    return count
+
+
+def _write_batch(
+    writer: Writer,
+    batch: list[dict[str, Any]],
+    checkpoint: Path | None,
+    exported: int,
+) -> int:
+    writer.write(batch)
+    exported += len(batch)
+    if checkpoint is not None:
+        _save_checkpoint(checkpoint, batch[-1]["_id"], exported, writer.position())
+    logger.info(f"Exported {exported} documents")
+    return len(batch)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl")
+    parser.add_argument(
+        "--uri", default=os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
+    )
+    parser.add_argument(
+        "--database", default=os.environ.get("MONGODB_DATABASE", "paimeng")
+    )
+    parser.add_argument("--collection", default="messages")
+    parser.add_argument("--group", action="append", default=[], dest="groups")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat)
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--strip-inline-data", action="store_true")
+    parser.add_argument("--checkpoint", type=Path)
+    parser.add_argument(
+        "--overwrite", action="store_true", help="replace an existing output"
+    )
+    args = parser.parse_args()
+
+    _, _, position = _load_checkpoint(args.checkpoint)
+    resuming = position is not None
+    exists = (
+        any(args.output.glob("part-*.parquet"))
+        if args.format == "parquet"
+        else args.output.exists()
+    )
+    if exists and not resuming and not args.overwrite:
+        parser.error(
+            f"{args.output} already exists,"
+            " pass --overwrite to replace it or --checkpoint to resume"
+        )
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    async def run() -> int:
+        client = AsyncIOMotorClient(args.uri)
+        writer: Writer = (
+            ParquetWriter(args.output, resume_at=position)
+            if args.format == "parquet"
+            else JsonlWriter(args.output, resume_at=position)
+        )
+        try:
+            return await export_messages(
+                client[args.database][args.collection],
+                writer,
+                group_openids=args.groups,
+                since=args.since,
+                until=args.until,
+                batch_size=args.batch_size,
+                strip=args.strip_inline_data,
+                checkpoint=args.checkpoint,
+            )
+        finally:
+            writer.close()
+            client.close()
+
+    logger.info(f"Done, exported {asyncio.run(run())} documents")
+
+
+if __name__ == "__main__":
+    main()
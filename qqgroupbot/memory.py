@@ -0,0 +1,428 @@
+"""
+Long-term group memory: archived turns are embedded into a per-group vector
+index, and the most relevant ones are recalled for each new prompt.
+
+Requires numpy.
+"""
+
+import asyncio
+import collections
+import hashlib
+import itertools
+import time
+import zlib
+from typing import Any, Iterable, Protocol
+
+from loguru import logger
+import numpy as np
+
+from .aichat.gemini import Content, embed_contents
+from .metrics import Gauge, STAGE_SECONDS
+
+__all__ = (
+    "Embedder",
+    "GeminiEmbedder",
+    "GroupMemory",
+    "HashingEmbedder",
+    "VectorIndex",
+    "extract_turns",
+)
+
+MEMORY_TURNS = Gauge("qqgroupbot_memory_turns", "Turns held in group memory indexes")
+
+
+class Embedder(Protocol):
+    # Stored with every vector, vectors of another embedder are ignored
+    name: str
+    dimension: int
+
+    async def embed(self, texts: list[str], *, query: bool = False) -> np.ndarray:
+        """
+        Return a `(len(texts), dimension)` float32 matrix of unit vectors
+        """
+        ...
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.float32(1e-12))
+
+
+class GeminiEmbedder:
+    """
+    Gemini `embedding-001`, at most `batch_size` texts per request
+    """
+
+    def __init__(self, dimension: int = 768, batch_size: int = 100) -> None:
+        self.name = "gemini-embedding-001"
+        self.dimension = dimension
+        self.batch_size = batch_size
+
+    async def embed(self, texts: list[str], *, query: bool = False) -> np.ndarray:
+        vectors: list[list[float]] = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors += await embed_contents(
+                texts[start : start + self.batch_size],
+                task_type="RETRIEVAL_QUERY" if query else "RETRIEVAL_DOCUMENT",
+            )
+        return normalize(np.array(vectors).reshape(len(texts), self.dimension))
+
+
+class HashingEmbedder:
+    """
+    Hashed character unigrams and bigrams. No network and no model, good
+    enough to find turns that share words, and a stand-in for tests.
+    """
+
+    def __init__(self, dimension: int = 1024) -> None:
+        self.name = f"hashing-{dimension}"
+        self.dimension = dimension
+
+    def _embed_one(self, text: str, out: np.ndarray) -> None:
+        text = "".join(text.lower().split())
+        for n in (1, 2):
+            for i in range(len(text) - n + 1):
+                out[zlib.crc32(text[i : i + n].encode()) % self.dimension] += n
+
+    async def embed(self, texts: list[str], *, query: bool = False) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for text, row in zip(texts, vectors):
+            self._embed_one(text, row)
+        return normalize(vectors)
+
+
+class VectorIndex:
+    """
+    Unit vectors in one contiguous float32 matrix with a payload per row.
+
+    Rows are appended in place, growing the matrix by doubling. Past
+    `max_size` rows the oldest quarter is dropped.
+    """
+
+    def __init__(self, dimension: int, max_size: int = 20000) -> None:
+        self.dimension = dimension
+        self.max_size = max_size
+        self.vectors = np.empty((64, dimension), dtype=np.float32)
+        self.payloads: list[Any] = []
+
+    def __len__(self) -> int:
+        return len(self.payloads)
+
+    def add(self, vectors: np.ndarray, payloads: list[Any]) -> None:
+        size = len(self.payloads)
+        if size + len(payloads) > self.max_size:
+            overflow = size + len(payloads) - self.max_size
+            drop = min(size, max(self.max_size // 4, overflow))
+            self.vectors[: size - drop] = self.vectors[drop:size]
+            del self.payloads[:drop]
+            size -= drop
+        if size + len(payloads) > len(self.vectors):
+            capacity = len(self.vectors)
+            while capacity < size + len(payloads):
+                capacity *= 2
+            vectors_ = np.empty((capacity, self.dimension), dtype=np.float32)
+            vectors_[:size] = self.vectors[:size]
+            self.vectors = vectors_
+        self.vectors[size : size + len(payloads)] = vectors
+        self.payloads += payloads
+
+    def search(self, query: np.ndarray, k: int) -> list[tuple[float, int]]:
+        """
+        Cosine similarity and row of the `k` rows nearest to `query`, best first
+        """
+        size = len(self.payloads)
+        if size == 0 or k <= 0:
+            return []
+        scores = self.vectors[:size] @ query
+        if k < size:
+            rows = np.argpartition(scores, -k)[-k:]
+        else:
+            rows = np.arange(size)
+        rows = rows[np.argsort(scores[rows])[::-1]]
+        return [(float(scores[row]), int(row)) for row in rows]
+
+
+def _text(content: Content) -> str:
+    return "".join(part.get("text", "") for part in content["parts"])
+
+
+def extract_turns(contents: list[Content]) -> list[tuple[str, str]]:
+    """
+    `(user text, model text)` of every answered turn
+    """
+    turns = []
+    for question, answer in zip(contents, contents[1:]):
+        if question.get("role", "user") == "user" and answer.get("role") == "model":
+            user, model = _text(question).strip(), _text(answer).strip()
+            if user and model:
+                turns.append((user, model))
+    return turns
+
+
+def turn_key(turn: tuple[str, str]) -> str:
+    return hashlib.sha1("\0".join(turn).encode()).hexdigest()
+
+
+class GroupMemory:
+    """
+    Per-group memory of archived turns.
+
+    Vectors are stored in `vectors_collection` as they are computed, so a
+    restart reads them back instead of embedding the history again. The
+    first `recall` for a group starts building its index in the background
+    from the newest `max_turns` stored vectors, then embeds archived turns
+    that have none yet. Until the index is ready `recall` returns nothing.
+    A failed build is retried after `retry_interval` seconds, keeping every
+    vector stored before the failure. At most `max_groups` indexes are kept,
+    the least recently used idle one is dropped to make room and rebuilt from
+    storage when its group comes back.
+
+    `recall` returns the `top_k` turns scoring at least `min_score` against
+    the prompt, oldest first, as Gemini contents. Memory is best effort:
+    failures are logged and recall nothing.
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        collection: Any,
+        vectors_collection: Any,
+        *,
+        top_k: int = 3,
+        min_score: float = 0.75,
+        max_turns: int = 20000,
+        max_groups: int = 32,
+        retry_interval: float = 60.0,
+    ) -> None:
+        self.embedder = embedder
+        self.collection = collection
+        self.vectors_collection = vectors_collection
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_turns = max_turns
+        self.max_groups = max_groups
+        self.retry_interval = retry_interval
+        # Indexes being built or ready, least recently used first, only those
+        # in `_ready` are searched
+        self.indexes: collections.OrderedDict[str, VectorIndex] = (
+            collections.OrderedDict()
+        )
+        self._seen: dict[str, set[str]] = {}
+        self._ready: set[str] = set()
+        self._loading: dict[str, asyncio.Task[None]] = {}
+        self._failed_at: dict[str, float] = {}
+        MEMORY_TURNS.set_function(
+            lambda: sum(len(index) for index in self.indexes.values())
+        )
+
+    async def start(self) -> None:
+        """
+        Create the indexes the first build of a group reads by
+        """
+        try:
+            await self.vectors_collection.create_index(
+                [("group_openid", 1), ("embedder", 1), ("_id", 1)]
+            )
+            await self.collection.create_index([("group_openid", 1), ("_id", 1)])
+        except Exception:
+            logger.exception("Failed to create memory indexes")
+
+    async def _embed(
+        self, group_openid: str, turns: list[tuple[str, str]]
+    ) -> np.ndarray:
+        """
+        Embed `turns` and store their vectors
+        """
+        vectors = await self.embedder.embed(
+            [f"{question}\n{answer}" for question, answer in turns]
+        )
+        await self.vectors_collection.insert_many(
+            [
+                {
+                    "group_openid": group_openid,
+                    "embedder": self.embedder.name,
+                    "key": turn_key(turn),
+                    "question": turn[0],
+                    "answer": turn[1],
+                    "vector": vector.tobytes(),
+                }
+                for turn, vector in zip(turns, vectors)
+            ],
+            ordered=False,
+        )
+        return vectors
+
+    def _unseen(
+        self, group_openid: str, turns: Iterable[tuple[str, str]]
+    ) -> list[tuple[str, str]]:
+        index = self.indexes[group_openid]
+        seen = self._seen[group_openid]
+        if len(seen) > 2 * self.max_turns:
+            # Forget turns the index has already dropped
+            seen.clear()
+            seen.update(map(turn_key, index.payloads))
+        new = []
+        for turn in turns:
+            if (key := turn_key(turn)) not in seen:
+                seen.add(key)
+                new.append(turn)
+        return new
+
+    async def _add(self, group_openid: str, turns: Iterable[tuple[str, str]]) -> None:
+        # The index may be evicted while embedding
+        index, seen = self.indexes[group_openid], self._seen[group_openid]
+        if new := self._unseen(group_openid, turns):
+            try:
+                vectors = await self._embed(group_openid, new)
+            except Exception:
+                seen.difference_update(map(turn_key, new))
+                raise
+            index.add(vectors, new)
+
+    async def _load_stored(self, group_openid: str) -> None:
+        cursor = self.vectors_collection.find(
+            {"group_openid": group_openid, "embedder": self.embedder.name},
+            projection={"question": 1, "answer": 1, "vector": 1},
+            sort=[("_id", -1)],
+            limit=self.max_turns,
+            batch_size=1000,
+        )
+        documents = [document async for document in cursor]
+        seen = self._seen[group_openid]
+        turns, vectors = [], []
+        for document in reversed(documents):
+            turn = (document["question"], document["answer"])
+            vector = np.frombuffer(document["vector"], dtype=np.float32)
+            if len(vector) != self.embedder.dimension or turn_key(turn) in seen:
+                continue
+            seen.add(turn_key(turn))
+            turns.append(turn)
+            vectors.append(vector)
+        if turns:
+            self.indexes[group_openid].add(np.array(vectors), turns)
+
+    async def _load_archived(self, group_openid: str) -> None:
+        cursor = self.collection.find(
+            {"group_openid": group_openid},
+            projection={"contents": 1},
+            sort=[("_id", -1)],
+            limit=self.max_turns,
+            batch_size=500,
+        )
+        # Newest document first
+        documents_turns = []
+        count = 0
+        async for document in cursor:
+            documents_turns.append(extract_turns(document.get("contents", [])))
+            count += len(documents_turns[-1])
+            if count >= self.max_turns:
+                break
+        turns = list(itertools.chain.from_iterable(reversed(documents_turns)))
+        turns = self._unseen(group_openid, turns[-self.max_turns :])
+        # Stored batch by batch, so a failure loses at most one batch
+        for start in range(0, len(turns), 500):
+            batch = turns[start : start + 500]
+            vectors = await self._embed(group_openid, batch)
+            self.indexes[group_openid].add(vectors, batch)
+
+    async def _load(self, group_openid: str) -> None:
+        try:
+            with STAGE_SECONDS.labels("memory_load").time():
+                await self._load_stored(group_openid)
+                await self._load_archived(group_openid)
+        except Exception:
+            logger.exception(f"Failed to load memory for {group_openid}")
+            del self.indexes[group_openid], self._seen[group_openid]
+            self._failed_at[group_openid] = time.monotonic()
+            return
+        finally:
+            del self._loading[group_openid]
+        self._ready.add(group_openid)
+        logger.info(
+            f"Loaded {len(self.indexes[group_openid])} turns for {group_openid}"
+        )
+
+    def _evict(self) -> None:
+        """
+        Drop least recently used ready indexes until there is room for one more
+        """
+        idle = [
+            group_openid for group_openid in self.indexes if group_openid in self._ready
+        ]
+        while len(self.indexes) >= self.max_groups and idle:
+            group_openid = idle.pop(0)
+            del self.indexes[group_openid], self._seen[group_openid]
+            self._ready.discard(group_openid)
+            logger.info(f"Evicted memory for {group_openid}")
+
+    def _start_loading(self, group_openid: str) -> None:
+        if group_openid in self.indexes or group_openid in self._loading:
+            return
+        failed_at = self._failed_at.get(group_openid, -self.retry_interval)
+        if time.monotonic() - failed_at < self.retry_interval:
+            return
+        self._evict()
+        self.indexes[group_openid] = VectorIndex(
+            self.embedder.dimension, self.max_turns
+        )
+        self._seen[group_openid] = set()
+        self._loading[group_openid] = asyncio.create_task(
+            self._load(group_openid), name=f"memory-load-{group_openid}"
+        )
+
+    async def recall(
+        self,
+        group_openid: str,
+        prompt: str,
+        *,
+        exclude: Iterable[Content] = (),
+    ) -> list[Content]:
+        """
+        Relevant past turns, leaving out those already in `exclude`
+        """
+        if group_openid not in self._ready:
+            self._start_loading(group_openid)
+            return []
+        self.indexes.move_to_end(group_openid)
+        index = self.indexes[group_openid]
+        excluded = set(extract_turns(list(exclude)))
+        try:
+            with STAGE_SECONDS.labels("memory_recall").time():
+                query = await self.embedder.embed([prompt], query=True)
+                hits = index.search(query[0], self.top_k + len(excluded))
+        except Exception:
+            logger.exception(f"Failed to recall memory for {group_openid}")
+            return []
+        rows = [
+            row
+            for score, row in hits
+            if score >= self.min_score and index.payloads[row] not in excluded
+        ]
+        contents: list[Content] = []
+        for row in sorted(rows[: self.top_k]):
+            question, answer = index.payloads[row]
+            contents.append({"role": "user", "parts": [{"text": question}]})
+            contents.append({"role": "model", "parts": [{"text": answer}]})
+        return contents
+
+    async def remember(self, group_openid: str, contents: list[Content]) -> None:
+        """
+        Embed and store the answered turns in `contents`, and index them if
+        the group's index exists
+        """
+        turns = extract_turns(contents)
+        try:
+            if group_openid in self.indexes:
+                self.indexes.move_to_end(group_openid)
+                await self._add(group_openid, turns)
+            elif turns:
+                # Picked up from storage when the index is built
+                await self._embed(group_openid, turns)
+        except Exception:
+            logger.exception(f"Failed to remember turns for {group_openid}")
+
+    async def close(self) -> None:
+        for task in tuple(self._loading.values()):
+            task.cancel()
+        await asyncio.gather(*self._loading.values(), return_exceptions=True)
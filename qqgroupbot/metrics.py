@@ -0,0 +1,301 @@
+"""
+Minimal Prometheus metrics.
+
+Everything runs on the event loop thread, so children update plain Python
+numbers without locking. Histogram buckets are allocated once per child.
+"""
+
+import asyncio
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+import math
+import time
+from typing import Callable, ClassVar, Iterator
+
+from loguru import logger
+
+__all__ = (
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "REGISTRY",
+    "render",
+    "serve_metrics",
+    "STAGE_SECONDS",
+    "GEMINI_ERRORS",
+    "GATEWAY_RECONNECTS",
+)
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+REGISTRY: dict[str, "Metric"] = {}
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = (
+        '{}="{}"'.format(
+            name,
+            value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\""),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    type: ClassVar[str]
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> None:
+        if name in REGISTRY:
+            raise ValueError(f"Duplicate metric: {name}")
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], object] = {}
+        REGISTRY[name] = self
+        if not labelnames:
+            self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"Expected labels {self.labelnames}, got {values}")
+        try:
+            return self._children[values]
+        except KeyError:
+            child = self._children[values] = self._new_child()
+            return child
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for suffix, labels, value in self.samples():
+            yield f"{self.name}{suffix}{labels} {_format_value(value)}"
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        for values, child in self._children.items():
+            yield "_total", _format_labels(self.labelnames, values), child.value
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.function: Callable[[], float] | None = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Compute the value at collection time instead
+        """
+        self.function = function
+
+    def get(self) -> float:
+        return self.value if self.function is None else self.function()
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.labels().set_function(function)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        for values, child in self._children.items():
+            yield "", _format_labels(self.labelnames, values), child.get()
+
+
+class _Timer:
+    __slots__ = ("child", "started")
+
+    def __init__(self, child: "_HistogramChild") -> None:
+        self.child = child
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        *,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        names = self.labelnames + ("le",)
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                labels = _format_labels(names, values + (_format_value(bound),))
+                yield "_bucket", labels, cumulative
+            labels = _format_labels(self.labelnames, values)
+            yield "_sum", labels, child.sum
+            yield "_count", labels, cumulative
+
+
+def render() -> str:
+    lines = [line for metric in REGISTRY.values() for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_request(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return
+        if method != "GET" or target.split("?", 1)[0] not in ("/", "/metrics"):
+            status, content_type, body = "404 Not Found", "text/plain", b"Not Found\n"
+        else:
+            status = "200 OK"
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+            body = render().encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+@asynccontextmanager
+async def serve_metrics(host: str, port: int):
+    """
+    Expose `REGISTRY` in the Prometheus text format over HTTP
+    """
+    server = await asyncio.start_server(_handle_request, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    try:
+        yield server
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+STAGE_SECONDS = Histogram(
+    "qqgroupbot_stage_seconds",
+    "Time spent in each stage of handling a message",
+    ("stage",),
+)
+GEMINI_ERRORS = Counter(
+    "qqgroupbot_gemini_errors",
+    "Gemini generate errors by class",
+    ("error",),
+)
+GATEWAY_RECONNECTS = Counter(
+    "qqgroupbot_gateway_reconnects",
+    "Gateway websocket reconnects",
+)
@@ -0,0 +1,157 @@
+"""
+Runtime instrumentation for finding what blocks the event loop.
+"""
+
+import asyncio
+import collections
+import datetime
+from pathlib import Path
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+
+from loguru import logger
+
+from .metrics import Counter, Histogram
+
+__all__ = ("LoopMonitor", "SamplingProfiler")
+
+LOOP_LAG_SECONDS = Histogram(
+    "qqgroupbot_loop_lag_seconds",
+    "How late the event loop woke up a sleeping monitor task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+LOOP_STALLS = Counter(
+    "qqgroupbot_loop_stalls",
+    "Times a callback blocked the event loop past the slow threshold",
+)
+
+
+class LoopMonitor:
+    """
+    Measure event loop lag with a sleeping task, and watch the loop from a
+    thread so a callback that blocks it longer than `slow_threshold` seconds
+    is logged together with the stack it is stuck in.
+
+    The task wakes every quarter of `slow_threshold`. A block delays the next
+    wake-up by at least its length minus one tick, so the watchdog reports
+    once the wake-up is `slow_threshold` minus one tick overdue. Every block
+    of `slow_threshold` or longer is reported, and so is a shorter one of at
+    least three quarters of it that starts right when the task is due. A
+    block that ends before the watchdog looks is still counted and logged by
+    the task when it wakes, without a stack.
+    """
+
+    def __init__(self, *, slow_threshold: float = 0.25) -> None:
+        self.interval = slow_threshold / 4
+        self.slow_threshold = slow_threshold
+        self.expected_wake = time.monotonic() + self.interval
+        self._reported = 0.0
+        self._task: asyncio.Task[None] | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    async def _beat(self) -> None:
+        while True:
+            self.expected_wake = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            blocked = time.monotonic() - self.expected_wake
+            LOOP_LAG_SECONDS.observe(max(0.0, blocked))
+            if (
+                blocked >= self.slow_threshold - self.interval
+                and self._reported != self.expected_wake
+            ):
+                LOOP_STALLS.inc()
+                logger.warning(f"Event loop was blocked for at least {blocked:.3f}s")
+
+    def _watch(self, thread_id: int) -> None:
+        while not self._stopped.wait(self.interval / 2):
+            expected_wake = self.expected_wake
+            blocked = time.monotonic() - expected_wake
+            if (
+                blocked < self.slow_threshold - self.interval
+                or expected_wake == self._reported
+            ):
+                continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            self._reported = expected_wake
+            LOOP_STALLS.inc()
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning(
+                f"Event loop blocked for at least {blocked:.3f}s so far at:\n{stack}"
+            )
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._beat(), name="loop-monitor")
+        self._stopped.clear()
+        self._watchdog = threading.Thread(
+            target=self._watch,
+            args=(threading.get_ident(),),
+            name="loop-watchdog",
+            daemon=True,
+        )
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        self._stopped.set()
+
+
+def _collapse(frame: FrameType | None) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Sample the event loop thread's stack from another thread and write the
+    result in the collapsed format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, directory: str | Path, *, interval: float = 0.005) -> None:
+        self.directory = Path(directory)
+        self.interval = interval
+        self.running = False
+
+    def _sample(self, thread_id: int, seconds: float) -> collections.Counter[str]:
+        samples: collections.Counter[str] = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                samples[_collapse(frame)] += 1
+            time.sleep(self.interval)
+        return samples
+
+    async def profile(self, seconds: float) -> Path:
+        """
+        Profile the calling event loop for `seconds` and return the output file
+        """
+        if self.running:
+            raise RuntimeError("Profiler is already running")
+        self.running = True
+        try:
+            samples = await asyncio.to_thread(
+                self._sample, threading.get_ident(), seconds
+            )
+        finally:
+            self.running = False
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / datetime.datetime.now().strftime(
+            "profile-%Y%m%d-%H%M%S.folded"
+        )
+        path.write_text(
+            "".join(f"{stack} {count}\n" for stack, count in samples.most_common()),
+            encoding="utf-8",
+        )
+        logger.info(f"Wrote {samples.total()} samples to {path}")
+        return path
@@ -0,0 +1,112 @@
+"""
+Append-only recording of raw gateway frames, and replay of recordings.
+
+Each record is a little-endian header of the receive time (float64 unix
+seconds) and the frame length (uint32), followed by the raw frame bytes.
+"""
+
+import asyncio
+import datetime
+import json
+from pathlib import Path
+import struct
+import time
+from typing import AsyncGenerator, BinaryIO, Iterable, Iterator
+
+from loguru import logger
+
+from .core import Event
+
+__all__ = ("FrameRecorder", "read_frames", "replay_events")
+
+HEADER = struct.Struct("<dI")
+
+# Frames `wss_connect` consumes itself instead of handing to `fetch_events`:
+# Reconnect, Invalid Session, Hello and Heartbeat ACK
+CONTROL_OPS = frozenset((7, 9, 10, 11))
+
+
+class FrameRecorder:
+    """
+    Write frames to `directory`, starting a new file once the current one
+    reaches `max_bytes`
+    """
+
+    def __init__(
+        self, directory: str | Path, *, max_bytes: int = 64 * 1024 * 1024
+    ) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.file: BinaryIO | None = None
+        self.size = 0
+
+    def _rotate(self) -> BinaryIO:
+        if self.file is not None:
+            self.file.close()
+        name = datetime.datetime.now().strftime("gateway-%Y%m%d-%H%M%S-%f.frames")
+        path = self.directory / name
+        logger.info(f"Recording gateway frames to {path}")
+        self.file = open(path, "ab")
+        self.size = 0
+        return self.file
+
+    def record(self, data: str | bytes, received_at: float | None = None) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+        file = self.file
+        if file is None or self.size >= self.max_bytes:
+            file = self._rotate()
+        file.write(
+            HEADER.pack(time.time() if received_at is None else received_at, len(data))
+        )
+        file.write(data)
+        self.size += HEADER.size + len(data)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_frames(paths: Iterable[str | Path]) -> Iterator[tuple[float, bytes]]:
+    """
+    Yield `(received_at, frame)` from recordings in the given order
+    """
+    for path in paths:
+        with open(path, "rb") as file:
+            while header := file.read(HEADER.size):
+                if len(header) < HEADER.size:
+                    logger.warning(f"Truncated record header in {path}")
+                    break
+                received_at, length = HEADER.unpack(header)
+                data = file.read(length)
+                if len(data) < length:
+                    logger.warning(f"Truncated record in {path}")
+                    break
+                yield received_at, data
+
+
+async def replay_events(
+    paths: Iterable[str | Path], *, speed: float | None = 1.0
+) -> AsyncGenerator[Event, None]:
+    """
+    Yield the events `fetch_events` would have yielded for a recording.
+    `speed` scales the original inter-arrival timing; `None` replays as
+    fast as possible.
+    """
+    first_received: float | None = None
+    started = time.monotonic()
+    for received_at, data in read_frames(paths):
+        event: Event = json.loads(data)
+        if event["op"] in CONTROL_OPS or event.get("t") in ("READY", "RESUMED"):
+            continue
+        if speed is not None:
+            if first_received is None:
+                first_received = received_at
+            delay = (received_at - first_received) / speed - (
+                time.monotonic() - started
+            )
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield event
@@ -0,0 +1,143 @@
+"""
+Answer cache keyed by meaning: a prompt close enough to one answered
+recently gets the same answer without calling Gemini.
+
+Requires numpy.
+"""
+
+import collections
+from typing import Awaitable, Callable
+
+from loguru import logger
+import numpy as np
+
+from .memory import Embedder
+from .metrics import Counter, Gauge, STAGE_SECONDS
+
+__all__ = ("SemanticCache",)
+
+SEMANTIC_CACHE_REQUESTS = Counter(
+    "qqgroupbot_semantic_cache_requests", "Semantic cache lookups", ("result",)
+)
+SEMANTIC_CACHE_ENTRIES = Gauge(
+    "qqgroupbot_semantic_cache_entries", "Answers held in the semantic cache"
+)
+SEMANTIC_CACHE_BYTES = Gauge(
+    "qqgroupbot_semantic_cache_bytes", "Estimated size of the semantic cache"
+)
+
+
+class SemanticCache:
+    """
+    Recent prompt vectors in one float32 matrix, one row per cached answer.
+
+    A lookup is a single matrix-vector product; the best row wins if its
+    cosine similarity reaches `threshold`. Entries are evicted least recently
+    used first once there are more than `max_entries`, or once the prompts,
+    answers and the whole allocated matrix take more than `max_bytes`. Evicted
+    rows are zeroed, so they can never match, and reused before the matrix
+    grows.
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        *,
+        threshold: float = 0.95,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+    ) -> None:
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        capacity = min(64, max_entries)
+        self.vectors = np.zeros((capacity, embedder.dimension), dtype=np.float32)
+        # row -> (prompt, answer, size), least recently used first
+        self.entries: collections.OrderedDict[int, tuple[str, str, int]] = (
+            collections.OrderedDict()
+        )
+        self.free_rows: list[int] = list(range(capacity - 1, -1, -1))
+        # Bytes of prompts and answers, the matrix is counted separately
+        self.size = 0
+        SEMANTIC_CACHE_ENTRIES.set_function(lambda: len(self.entries))
+        SEMANTIC_CACHE_BYTES.set_function(lambda: self.nbytes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.size + self.vectors.nbytes
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _lookup(self, vector: np.ndarray) -> str | None:
+        if not self.entries:
+            return None
+        scores = self.vectors @ vector
+        row = int(np.argmax(scores))
+        if scores[row] < self.threshold:
+            return None
+        self.entries.move_to_end(row)
+        return self.entries[row][1]
+
+    def _evict(self) -> None:
+        row, (_, _, size) = self.entries.popitem(last=False)
+        self.vectors[row] = 0
+        self.free_rows.append(row)
+        self.size -= size
+
+    def _grown_capacity(self) -> int:
+        capacity = len(self.vectors)
+        return min(capacity * 2, max(self.max_entries, capacity))
+
+    def _insert(self, vector: np.ndarray, prompt: str, answer: str) -> None:
+        size = len(prompt.encode()) + len(answer.encode())
+        row_bytes = self.vectors.itemsize * self.vectors.shape[1]
+        while self.entries:
+            # The matrix this insert needs, grown if no row is free
+            capacity = (
+                len(self.vectors) if self.free_rows else self._grown_capacity()
+            )
+            if (
+                len(self.entries) < self.max_entries
+                and self.size + size + capacity * row_bytes <= self.max_bytes
+            ):
+                break
+            self._evict()
+        if not self.free_rows:
+            capacity, new_capacity = len(self.vectors), self._grown_capacity()
+            vectors = np.zeros((new_capacity, self.vectors.shape[1]), np.float32)
+            vectors[:capacity] = self.vectors
+            self.vectors = vectors
+            self.free_rows = list(range(new_capacity - 1, capacity - 1, -1))
+        row = self.free_rows.pop()
+        self.vectors[row] = vector
+        self.entries[row] = (prompt, answer, size)
+        self.size += size
+
+    async def get_or_generate(
+        self, prompt: str, generate: Callable[[], Awaitable[str]]
+    ) -> str:
+        """
+        Return the cached answer for `prompt`, or `generate` one and cache it.
+        Errors raised by `generate` propagate and nothing is cached.
+        """
+        try:
+            with STAGE_SECONDS.labels("semantic_cache_lookup").time():
+                vector = (await self.embedder.embed([prompt], query=True))[0]
+                answer = self._lookup(vector)
+        except Exception:
+            logger.exception("Failed to look up the semantic cache")
+            SEMANTIC_CACHE_REQUESTS.labels("error").inc()
+            return await generate()
+        if answer is not None:
+            SEMANTIC_CACHE_REQUESTS.labels("hit").inc()
+            return answer
+        SEMANTIC_CACHE_REQUESTS.labels("miss").inc()
+        answer = await generate()
+        self._insert(vector, prompt, answer)
+        return answer
+
+    def clear(self) -> None:
+        while self.entries:
+            self._evict()
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from typing import Any, Coroutine
+
+from loguru import logger
+
+__all__ = ("TaskRegistry",)
+
+
+class TaskRegistry:
+    """
+    Keep strong references to background tasks so they can be counted,
+    inspected and drained on shutdown.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: dict[asyncio.Task[Any], float] = {}
+        self._finished = asyncio.Event()
+        self.accepting = True
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def spawn(
+        self, coro: Coroutine[Any, Any, Any], *, name: str | None = None
+    ) -> asyncio.Task[Any]:
+        if not self.accepting:
+            coro.close()
+            raise RuntimeError("Task registry is draining")
+        task = asyncio.create_task(coro, name=name)
+        self._tasks[task] = time.monotonic()
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task: asyncio.Task[Any]) -> None:
+        self._tasks.pop(task, None)
+        self._finished.set()
+        if task.cancelled():
+            return
+        if (error := task.exception()) is not None:
+            logger.opt(exception=error).error(f"Task {task.get_name()} failed")
+
+    async def wait_below(self, limit: int) -> None:
+        """
+        Wait until fewer than `limit` tasks are running
+        """
+        while len(self._tasks) >= limit:
+            self._finished.clear()
+            await self._finished.wait()
+
+    def in_flight(self) -> list[tuple[str, float]]:
+        """
+        Name and age in seconds of every running task, oldest first
+        """
+        now = time.monotonic()
+        return [
+            (task.get_name(), now - started) for task, started in self._tasks.items()
+        ]
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Stop accepting new tasks and wait up to `timeout` seconds for the
+        running ones. Tasks still running after that are cancelled; return
+        how many were cancelled.
+        """
+        self.accepting = False
+        if not self._tasks:
+            return 0
+        logger.info(f"Draining {len(self._tasks)} tasks")
+        _, pending = await asyncio.wait(tuple(self._tasks), timeout=timeout)
+        for task in pending:
+            logger.warning(f"Cancel task {task.get_name()} after drain timeout")
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        return len(pending)
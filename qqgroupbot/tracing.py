@@ -0,0 +1,251 @@
+"""
+Lightweight per-message tracing.
+
+A trace is started for each message and the current span is carried through
+`contextvars`, so nested `span()` calls anywhere in the handler become its
+children. Finished traces are kept when randomly sampled, when they failed or
+when they were slower than a threshold, then handed to an exporter.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import contextvars
+import json
+from pathlib import Path
+import random
+import time
+from typing import Any, Iterator, Protocol
+
+import httpx
+from loguru import logger
+
+__all__ = (
+    "Span",
+    "Tracer",
+    "JsonlExporter",
+    "OtlpHttpExporter",
+    "initial_tracer",
+    "start_trace",
+    "span",
+)
+
+
+class Span:
+    __slots__ = (
+        "trace",
+        "span_id",
+        "parent_id",
+        "name",
+        "attributes",
+        "start_ns",
+        "end_ns",
+        "error",
+    )
+
+    def __init__(
+        self,
+        trace: list["Span"],
+        parent: "Span | None",
+        name: str,
+        attributes: dict[str, Any],
+    ) -> None:
+        self.trace = trace
+        self.span_id = random.getrandbits(64)
+        self.parent_id = None if parent is None else parent.span_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error: str | None = None
+        trace.append(self)
+
+    @property
+    def duration(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_otlp(self, trace_id: int) -> dict[str, Any]:
+        return {
+            "traceId": f"{trace_id:032x}",
+            "spanId": f"{self.span_id:016x}",
+            "parentSpanId": "" if self.parent_id is None else f"{self.parent_id:016x}",
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}}
+                for key, value in self.attributes.items()
+            ],
+            "status": (
+                {"code": 2, "message": self.error}
+                if self.error is not None
+                else {"code": 1}
+            ),
+        }
+
+
+class Exporter(Protocol):
+    def export(self, trace_id: int, spans: list[Span]) -> None:
+        ...
+
+    async def aclose(self) -> None:
+        ...
+
+
+class JsonlExporter:
+    """
+    Append one OTLP/JSON span object per line to a local file
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.file = open(path, "a", encoding="utf-8")
+
+    def export(self, trace_id: int, spans: list[Span]) -> None:
+        self.file.write(
+            "".join(
+                json.dumps(span.to_otlp(trace_id), ensure_ascii=False) + "\n"
+                for span in spans
+            )
+        )
+        self.file.flush()
+
+    async def aclose(self) -> None:
+        self.file.close()
+
+
+class OtlpHttpExporter:
+    """
+    Batch traces and POST them to an OTLP/HTTP JSON collector
+    """
+
+    def __init__(
+        self, endpoint: str, *, service_name: str, interval: float = 5
+    ) -> None:
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service_name = service_name
+        self.interval = interval
+        self.pending: list[dict[str, Any]] = []
+        self.client = httpx.AsyncClient(timeout=10)
+        self.flusher = asyncio.create_task(self._flush_forever())
+
+    def export(self, trace_id: int, spans: list[Span]) -> None:
+        self.pending.extend(span.to_otlp(trace_id) for span in spans)
+
+    async def _flush_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self.pending:
+            return
+        spans, self.pending = self.pending, []
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {"scope": {"name": "qqgroupbot"}, "spans": spans}
+                    ],
+                }
+            ]
+        }
+        try:
+            resp = await self.client.post(self.url, json=body)
+            if not resp.is_success:
+                logger.warning(f"Failed to export traces: {resp.status_code}")
+        except httpx.HTTPError as error:
+            logger.warning(f"Failed to export traces: {error!r}")
+
+    async def aclose(self) -> None:
+        self.flusher.cancel()
+        await self.flush()
+        await self.client.aclose()
+
+
+class Tracer:
+    def __init__(
+        self, exporter: Exporter, *, sample_rate: float, slow_threshold: float
+    ) -> None:
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    def finish(self, trace_id: int, spans: list[Span]) -> None:
+        root = spans[0]
+        if (
+            root.error is not None
+            or root.duration >= self.slow_threshold
+            or random.random() < self.sample_rate
+        ):
+            self.exporter.export(trace_id, spans)
+
+
+CurrentTracer: contextvars.ContextVar[Tracer | None] = contextvars.ContextVar(
+    "CurrentTracer", default=None
+)
+CurrentSpan: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "CurrentSpan", default=None
+)
+
+
+@asynccontextmanager
+async def initial_tracer(
+    exporter: Exporter, *, sample_rate: float = 0.01, slow_threshold: float = 10
+):
+    tracer = Tracer(exporter, sample_rate=sample_rate, slow_threshold=slow_threshold)
+    token = CurrentTracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        CurrentTracer.reset(token)
+        await exporter.aclose()
+
+
+@contextmanager
+def _record(span: Span) -> Iterator[Span]:
+    token = CurrentSpan.set(span)
+    try:
+        yield span
+    except BaseException as error:
+        span.error = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        CurrentSpan.reset(token)
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Span | None]:
+    """
+    Start a new trace; does nothing when no tracer is configured
+    """
+    if (tracer := CurrentTracer.get()) is None:
+        yield None
+        return
+    trace_id = random.getrandbits(128)
+    spans: list[Span] = []
+    try:
+        with _record(Span(spans, None, name, attributes)) as root:
+            yield root
+    finally:
+        tracer.finish(trace_id, spans)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span | None]:
+    """
+    Record a child of the current span; does nothing outside a trace
+    """
+    if (parent := CurrentSpan.get()) is None:
+        yield None
+        return
+    with _record(Span(parent.trace, parent, name, attributes)) as child:
+        yield child
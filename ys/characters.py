@@ -0,0 +1,199 @@
+"""
+Genshin characters from `characters.json`, loaded once and indexed so every
+lookup is a dict access.
+
+Names are also indexed by pinyin and pinyin initials when pypinyin is
+installed, and every prefix of a name or material maps to its matches.
+"""
+
+import functools
+import json
+from pathlib import Path
+from typing import Iterable
+
+__all__ = ("Character", "CharacterDatabase", "load_characters")
+
+HERE = Path(__file__).absolute().parent
+CHARACTERS_FILE = HERE / "characters.json"
+
+RARITY_ALIASES = {"4星": 4, "四星": 4, "5星": 5, "五星": 5}
+
+
+class Character:
+    __slots__ = (
+        "name",
+        "rarity",
+        "weapon",
+        "element",
+        "photo",
+        "max_health_points",
+        "max_attack",
+        "max_defense",
+        "breakout_increase",
+        "breakthrough_materials",
+        "talent_materials",
+    )
+
+    def __init__(self, data: dict) -> None:
+        self.name: str = data["name"]
+        self.rarity = int(data["rarity"].removesuffix("星") or 0)
+        self.weapon: str = data["weapon"]
+        self.element: str = data["element"]
+        self.photo: str | None = data["photo"]
+        self.max_health_points: str = data["max_health_points"]
+        self.max_attack: str = data["max_attack"]
+        self.max_defense: str = data["max_defense"]
+        self.breakout_increase: str = data["breakout_increase"]
+        self.breakthrough_materials = tuple(
+            material["name"] for material in data["materials_needed_for_breakthrough"]
+        )
+        self.talent_materials = tuple(
+            material["name"] for material in data["materials_needed_for_talent"]
+        )
+
+    def __repr__(self) -> str:
+        return f"<Character {self.name}>"
+
+    def describe(self) -> str:
+        lines = [f"{self.name} {self.rarity}星 {self.element} {self.weapon}".rstrip()]
+        if self.max_health_points:
+            lines.append(
+                f"90级 生命 {self.max_health_points} 攻击力 {self.max_attack}"
+                f" 防御力 {self.max_defense} 突破加成 {self.breakout_increase}"
+            )
+        if self.breakthrough_materials:
+            lines.append("突破材料：" + "、".join(self.breakthrough_materials))
+        if self.talent_materials:
+            lines.append("天赋材料：" + "、".join(self.talent_materials))
+        return "\n".join(lines)
+
+
+def normalize(text: str) -> str:
+    text = "".join(c for c in text.lower() if c not in " 「」『』·・")
+    return text.removesuffix("元素")
+
+
+def _pinyin(name: str) -> tuple[str, ...]:
+    try:
+        from pypinyin import Style, lazy_pinyin
+    except ImportError:
+        return ()
+    return (
+        "".join(lazy_pinyin(name)),
+        "".join(lazy_pinyin(name, style=Style.FIRST_LETTER)),
+    )
+
+
+def _group[K, V](pairs: Iterable[tuple[K, V]]) -> dict[K, tuple[V, ...]]:
+    grouped: dict[K, list[V]] = {}
+    for key, value in pairs:
+        values = grouped.setdefault(key, [])
+        if value not in values:
+            values.append(value)
+    return {key: tuple(values) for key, values in grouped.items()}
+
+
+def _prefixes(key: str) -> Iterable[str]:
+    return (key[:end] for end in range(1, len(key) + 1))
+
+
+class CharacterDatabase:
+    """
+    Characters indexed by name (exact, pinyin and prefix), element, weapon,
+    rarity and by the materials they need
+    """
+
+    def __init__(self, characters: Iterable[Character]) -> None:
+        self.characters = tuple(characters)
+        aliases = [
+            (alias, character)
+            for character in self.characters
+            for alias in (normalize(character.name), *_pinyin(character.name))
+        ]
+        self.by_name = _group(aliases)
+        self.by_name_prefix = _group(
+            (prefix, character)
+            for alias, character in aliases
+            for prefix in _prefixes(alias)
+        )
+        self.by_element = _group(
+            (character.element, character) for character in self.characters
+        )
+        self.by_weapon = _group(
+            (character.weapon, character)
+            for character in self.characters
+            if character.weapon
+        )
+        self.by_rarity = _group(
+            (character.rarity, character) for character in self.characters
+        )
+        self.by_material = _group(
+            (material, character)
+            for character in self.characters
+            for material in (
+                *character.breakthrough_materials,
+                *character.talent_materials,
+            )
+        )
+        self.material_by_prefix = _group(
+            (prefix, material)
+            for material in self.by_material
+            for prefix in _prefixes(normalize(material))
+        )
+
+    def find_by_name(self, name: str) -> tuple[Character, ...]:
+        key = normalize(name)
+        return self.by_name.get(key) or self.by_name_prefix.get(key, ())
+
+    def find_materials(self, name: str) -> tuple[str, ...]:
+        if name in self.by_material:
+            return (name,)
+        return self.material_by_prefix.get(normalize(name), ())
+
+    def filter(self, words: list[str]) -> tuple[Character, ...] | None:
+        """
+        Characters matching every element, weapon and rarity in `words`,
+        `None` if some word is none of those
+        """
+        matches: set[Character] | None = None
+        for word in words:
+            if (key := normalize(word)) in self.by_element:
+                found = self.by_element[key]
+            elif word in self.by_weapon:
+                found = self.by_weapon[word]
+            elif word in RARITY_ALIASES:
+                found = self.by_rarity.get(RARITY_ALIASES[word], ())
+            else:
+                return None
+            matches = set(found) if matches is None else matches & set(found)
+        if matches is None:
+            return None
+        return tuple(c for c in self.characters if c in matches)
+
+    def answer(self, query: str) -> str | None:
+        """
+        Reply to a character, material or element/weapon/rarity query, `None`
+        if nothing matches
+        """
+        query = query.strip()
+        if not query:
+            return None
+        if (characters := self.filter(query.split())) is not None:
+            return f"{query}：" + ("、".join(c.name for c in characters) or "没有")
+        if characters := self.find_by_name(query):
+            if len(characters) == 1:
+                return characters[0].describe()
+            return "是哪一位呢？" + "、".join(c.name for c in characters)
+        if materials := self.find_materials(query):
+            return "\n".join(
+                f"{material}："
+                + "、".join(c.name for c in self.by_material[material])
+                for material in materials
+            )
+        return None
+
+
+@functools.cache
+def load_characters(path: Path = CHARACTERS_FILE) -> CharacterDatabase:
+    data = json.loads(path.read_text(encoding="utf-8"))
+    return CharacterDatabase(map(Character, data))